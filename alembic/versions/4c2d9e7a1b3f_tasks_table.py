@@ -0,0 +1,41 @@
+"""tasks_table
+
+Revision ID: 4c2d9e7a1b3f
+Revises: 95ed00acdb4b
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c2d9e7a1b3f'
+down_revision = '95ed00acdb4b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('tasks',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('device_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('from_time', sa.DateTime(), nullable=True),
+    sa.Column('to_time', sa.DateTime(), nullable=True),
+    sa.Column('switch_to', sa.Boolean(), nullable=False),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('claimed_by', sa.String(), nullable=True),
+    sa.Column('claimed_at', sa.DateTime(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('completed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_tasks_device_id'), 'tasks', ['device_id'], unique=False)
+    op.create_index('ix_tasks_status_created_at', 'tasks', ['status', 'created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tasks_status_created_at', table_name='tasks')
+    op.drop_index(op.f('ix_tasks_device_id'), table_name='tasks')
+    op.drop_table('tasks')
@@ -0,0 +1,24 @@
+"""tasks_partition
+
+Revision ID: 7e1f3a9c5d20
+Revises: 4c2d9e7a1b3f
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e1f3a9c5d20'
+down_revision = '4c2d9e7a1b3f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column('partition', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tasks', 'partition')
@@ -0,0 +1,26 @@
+"""tasks_dead_letters
+
+Revision ID: b8d4c6e2f071
+Revises: 7e1f3a9c5d20
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d4c6e2f071'
+down_revision = '7e1f3a9c5d20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column('deliveries', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('tasks', sa.Column('error', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tasks', 'error')
+    op.drop_column('tasks', 'deliveries')
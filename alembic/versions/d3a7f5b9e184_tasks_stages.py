@@ -0,0 +1,26 @@
+"""tasks_stages
+
+Revision ID: d3a7f5b9e184
+Revises: b8d4c6e2f071
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a7f5b9e184'
+down_revision = 'b8d4c6e2f071'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column('started_at', sa.DateTime(), nullable=True))
+    op.add_column('tasks', sa.Column('stages', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tasks', 'stages')
+    op.drop_column('tasks', 'started_at')
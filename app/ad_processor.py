@@ -1,56 +1,579 @@
 import datetime
 import time
-from queue import Queue, Empty
-from threading import Thread
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Thread
+from typing import Callable, Optional
 
+import app
 import app.data_classes as dc
-from app import campaign_generator
+import app.log_lib as log_lib
+from app import campaign_generator, exceptions
 from app.addreality_handler import AddRealityHandler
+from app.metrics import registry
+from app.scheduler import ScheduledJob, Scheduler
+from app.session_cache import SessionCache
+from app.task_queue import MemoryTaskQueue, PostgresTaskQueue
+from app.worker_pool import KeyedWorkerPool
+
+start_skew_histogram = registry.histogram(
+    'ad_processor_start_skew_seconds',
+    'Difference between from_time of task and the moment the campaign has been started',
+    buckets=(-5., -2., -1., -.5, -.25, 0., .25, .5, 1., 2., 5., 10., 30., 60.),
+)
+swap_gap_histogram = registry.histogram(
+    'ad_processor_swap_gap_seconds',
+    'Time between the old campaigns stopping and the new one playing, negative values are overlaps',
+    buckets=(-5., -1., -.5, -.25, -.1, 0., .1, .25, .5, 1., 2., 5., 10.),
+)
+coalesced_counter = registry.counter(
+    'ad_processor_coalesced_total', 'Turn-on tasks dropped before start because a newer one has replaced them')
+TERMINAL_STATUSES = frozenset(('done', 'failed', 'superseded', 'expired', 'dead'))
 
 
 class AdProcessor:
-    def __init__(self, tasks_queue: Queue['dc.TaskWrapper']):
+    __logger: 'log_lib' = None
+
+    def __init__(self, tasks_queue: 'MemoryTaskQueue | PostgresTaskQueue'):
         self.alive = False
         self.tasks_queue = tasks_queue
         self.tasks_processor_thread = Thread(target=self.task_processor)
+        self.config = app.context.processor_config
+        self.sessions = SessionCache(app.context.add_reality_config)
+        # tasks of one device never interleave, different devices are handled in parallel
+        self.pool = KeyedWorkerPool(self.config.workers, 'ad-processor')
+        # campaign swaps wait for from_time here instead of holding a worker
+        self.scheduler = Scheduler('ad-scheduler')
+        # the latest accepted slot of every device, it owns the scheduled turn-off at to_time
+        self.bookings: dict[int, 'dc.Booking'] = {}
+        self._bookings_lock = Lock()
+        # content of accepted turn-on tasks is resolved and uploaded in background within this budget
+        self.prefetcher = ThreadPoolExecutor(self.config.prefetch_concurrency, 'ad-prefetch')
+        self._prepared: dict[str, Future] = {}
+        # turn-on tasks not started yet by device_id and from_time, a newer task with the same key replaces them
+        self._pending: dict[tuple[int, Optional[datetime.datetime]], tuple['dc.TaskWrapper', 'ScheduledJob']] = {}
+        self._pending_lock = Lock()
+        # platforms whose device state is being refreshed
+        self._refreshing: set[tuple[str, int]] = set()
+        # recent tasks by id, to report their status
+        self.tasks: OrderedDict[str, 'dc.TaskWrapper'] = OrderedDict()
+        self._tasks_lock = Lock()
+
+        registry.gauge(
+            'ad_processor_tasks_queue_depth', 'Tasks received but not dispatched to workers yet'
+        ).set_function(self.tasks_queue.qsize)
+        registry.gauge(
+            'ad_processor_queue_depth', 'Tasks waiting for a free worker or for the previous task of the device'
+        ).set_function(lambda: self.queue_depth)
+        registry.gauge(
+            'ad_processor_in_flight', 'Tasks being handled right now'
+        ).set_function(lambda: self.in_flight)
+        registry.gauge(
+            'ad_processor_workers', 'Worker threads of the processor'
+        ).set_function(lambda: self.pool.workers)
+        registry.gauge(
+            'ad_processor_worker_utilization', 'Share of workers handling a task right now'
+        ).set_function(lambda: self.in_flight / self.pool.workers)
+        registry.gauge(
+            'ad_processor_scheduled', 'Campaign swaps and turn-offs waiting for their time'
+        ).set_function(lambda: len(self.scheduler))
+        registry.gauge(
+            'ad_processor_prefetching', 'Turn-on tasks whose content is not ready yet'
+        ).set_function(lambda: sum(not future.done() for future in list(self._prepared.values())))
+
+    @property
+    def logger(self) -> 'log_lib.Logger':
+        if self.__logger is None:
+            self.__logger = log_lib.get_logger(self.__class__.__name__)
+        return self.__logger
+
+    @property
+    def queue_depth(self) -> int:
+        return self.tasks_queue.qsize() + self.pool.queue_depth
+
+    @property
+    def in_flight(self) -> int:
+        return self.pool.in_flight
 
     def task_processor(self):
         while self.alive:
             try:
-                task_wrapper = self.tasks_queue.get_nowait()
-                self.handle(task_wrapper)
-            except Empty:
-                time.sleep(.25)
+                task_wrappers = self.tasks_queue.get()
+            except Exception as ex:
+                self.logger.exception(f'Tasks are not received: {ex!r}')
+                time.sleep(1)
+                continue
+            for task_wrapper in task_wrappers:
+                try:
+                    self.accept(task_wrapper)
+                except Exception as ex:
+                    # a broken task must not stop the tasks after it
+                    self.logger.exception(f'Task {task_wrapper.id} is not accepted: {ex!r}')
+                    task_wrapper.error = f'accept: {ex!r}'
+                    self.complete(task_wrapper, 'failed')
+
+    def accept(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        self.register_task(task_wrapper)
+        to_time = task_wrapper.task.to_time
+        if task_wrapper.switch_to is True and to_time is not None and to_time <= datetime.datetime.utcnow():
+            # restored from durable queue after its slot is over
+            self.logger.warning(f'Task {task_wrapper.id}: slot is over at {to_time}, skipped')
+            self.complete(task_wrapper, 'expired')
+            return
+        task_wrapper.status = 'scheduled'
+        if task_wrapper.switch_to is True:
+            if self.book(task_wrapper):
+                self._prepared[task_wrapper.id] = self.prefetcher.submit(self.prepare, task_wrapper)
+                run_at = datetime.datetime.utcnow()
+                if task_wrapper.task.from_time is not None:
+                    lead = self.config.swap_lead if self.config.atomic_swap else self.config.switch_lead
+                    run_at = task_wrapper.task.from_time - datetime.timedelta(seconds=lead)
+                with self._pending_lock:
+                    self.supersede(task_wrapper)
+                    job = self.scheduler.schedule(
+                        run_at, self.pool.submit, task_wrapper.task.device_id, self.switch, task_wrapper)
+                    self._pending[self.pending_key(task_wrapper)] = (task_wrapper, job)
+            else:
+                task_wrapper.readiness = dc.Readiness.READY
+        else:
+            self.pool.submit(task_wrapper.task.device_id, self.turn_off, task_wrapper)
+
+    @staticmethod
+    def pending_key(task_wrapper: 'dc.TaskWrapper') -> tuple[int, Optional[datetime.datetime]]:
+        return task_wrapper.task.device_id, task_wrapper.task.from_time
+
+    def supersede(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        """
+        Drop the pending turn-on task with the same device and from_time, called under _pending_lock.
+        """
+        pending = self._pending.pop(self.pending_key(task_wrapper), None)
+        if pending is None:
+            return
+        old, job = pending
+        job.cancel()
+        old.superseded_by = task_wrapper.id
+        old.readiness = dc.Readiness.SUPERSEDED
+        future = self._prepared.pop(old.id, None)
+        if future is not None:
+            future.cancel()
+        coalesced_counter.inc()
+        self.complete(old, 'superseded')
+        self.logger.info(f'Task {old.id}: superseded by task {task_wrapper.id} on device {task_wrapper.task.device_id}')
+
+    def complete(self, task_wrapper: 'dc.TaskWrapper', status: str) -> None:
+        """
+        Mark task finished in tasks queue, it will not be restored after restart.
+        A task keeps the first terminal status, e.g. a superseded task taken over by a slot is not done later.
+        :param status: done, failed, superseded or expired
+        """
+        with self._tasks_lock:
+            if task_wrapper.status in TERMINAL_STATUSES:
+                return
+            task_wrapper.status = status
+            task_wrapper.completed_at = datetime.datetime.utcnow()
+        try:
+            self.tasks_queue.complete(task_wrapper, status)
+        except Exception as ex:
+            self.logger.exception(f'Task {task_wrapper.id}: status {status} is not stored: {ex!r}')
+
+    def register_task(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        with self._tasks_lock:
+            self.tasks[task_wrapper.id] = task_wrapper
+            while len(self.tasks) > self.config.tasks_history:
+                self.tasks.popitem(last=False)
+
+    def get_task(self, task_id: str) -> Optional['dc.TaskWrapper']:
+        return self.tasks.get(task_id)
+
+    def get_device_tasks(self, device_id: int) -> list['dc.TaskWrapper']:
+        """
+        :return: recent tasks of the device, the latest first
+        """
+        with self._tasks_lock:
+            return [
+                task_wrapper for task_wrapper in reversed(self.tasks.values())
+                if task_wrapper.task.device_id == device_id
+            ]
+
+    def book(self, task_wrapper: 'dc.TaskWrapper') -> bool:
+        """
+        Register the slot of turn-on task with its turn-off at to_time.
+        A slot starting right where the previous one of the device ends takes over its turn-off,
+        so the campaign is not deleted and created again back to back. The same holds for a slot
+        which has arrived after the later slot it ends at.
+        :return: False if the slot continues the same content and no campaign swap is needed
+        """
+        task = task_wrapper.task
+        from_time = task.from_time or datetime.datetime.utcnow()
+        gap = datetime.timedelta(seconds=self.config.merge_gap)
+        with self._bookings_lock:
+            previous = self.bookings.get(task.device_id)
+            if previous is not None and previous.task_wrapper.status in TERMINAL_STATUSES:
+                # the slot has failed before its start, the new task plays on its own
+                previous = None
+            adjacent = (
+                previous is not None
+                and previous.to_time is not None
+                and previous.from_time <= from_time <= previous.to_time + gap
+            )
+            if adjacent and previous.turn_off_job is not None:
+                previous.turn_off_job.cancel()
+
+            # the later slot of the device has arrived first and starts where this one ends
+            followed = (
+                previous is not None
+                and not adjacent
+                and task.to_time is not None
+                and from_time < previous.from_time <= task.to_time + gap
+            )
+
+            merged = adjacent and previous.task_wrapper.task.name == task.name
+            if followed:
+                # the later slot swaps this campaign out at its start, so this one has no turn-off
+                previous.taken_over.append(task_wrapper)
+                self.logger.info(
+                    f'Task {task_wrapper.id}: slot on device {task.device_id} is taken over '
+                    f'by task {previous.task_wrapper.id} at {previous.from_time}')
+                return True
+            if merged:
+                booking = previous
+                booking.to_time = task.to_time
+                booking.merged.append(task_wrapper)
+                self.logger.info(
+                    f'Task {task_wrapper.id}: merged with slot of task {previous.task_wrapper.id} '
+                    f'on device {task.device_id} till {task.to_time}')
+            else:
+                booking = dc.Booking(task_wrapper, from_time, task.to_time)
+                if adjacent:
+                    booking.taken_over = [previous.task_wrapper, *previous.merged, *previous.taken_over]
+
+            booking.turn_off_job = None
+            if booking.to_time is not None:
+                booking.turn_off_job = self.scheduler.schedule(
+                    booking.to_time, self.pool.submit, task.device_id, self.end_booking, booking, booking.to_time)
+            if previous is None or previous.from_time <= from_time:
+                self.bookings[task.device_id] = booking
+        return not merged
+
+    def end_booking(self, booking: 'dc.Booking', to_time: datetime.datetime) -> None:
+        with self._bookings_lock:
+            # the slot has been taken over or extended after the turn-off has been fired
+            if booking.turn_off_job is None or booking.turn_off_job.cancelled or booking.to_time != to_time:
+                return
+            if self.bookings.get(booking.task_wrapper.task.device_id) is booking:
+                del self.bookings[booking.task_wrapper.task.device_id]
+        self.logger.info(
+            f'Task {booking.task_wrapper.id}: slot on device {booking.task_wrapper.task.device_id} is over')
+        # tasks taken over by a slot which has not started are ended with it
+        for task_wrapper in [booking.task_wrapper, *booking.taken_over]:
+            self.end_slot(task_wrapper)
+        for task_wrapper in booking.merged:
+            self.complete(task_wrapper, 'done')
+
+    def end_slot(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        """
+        Delete the campaign of turn-on task at the end of its slot, campaigns of later slots of the device stay.
+        The campaign is deleted whatever its status, one created ahead of a swap which has failed is still paused.
+        """
+        if task_wrapper.campaign_id is not None:
+            try:
+                with task_wrapper.stage('auth'):
+                    handler = self.sessions.get(task_wrapper.task.user_data)
+                with task_wrapper.stage('delete'):
+                    handler.delete_campaigns([task_wrapper.campaign_id], only_playing=False)
+            except Exception as ex:
+                self.retry(task_wrapper, 'turn_off', self.end_slot, ex)
+                return
+        self.complete(task_wrapper, 'done')
 
     def start(self):
         self.alive = True
+        self.pool.start()
+        self.scheduler.start()
+        self.tasks_queue.restore()
         self.tasks_processor_thread.start()
+        if self.tasks_queue.durable:
+            self.scheduler.schedule(datetime.datetime.utcnow(), self.renew_tasks)
+        if self.sessions.config.device_state_refresh_interval > 0:
+            self.scheduler.schedule(datetime.datetime.utcnow(), self.refresh_device_states)
 
     def stop(self):
         self.alive = False
         self.tasks_processor_thread.join()
+        self.scheduler.stop()
+        self.prefetcher.shutdown(wait=False, cancel_futures=True)
+        self.pool.stop()
 
-    @staticmethod
-    def handle(task_wrapper: 'dc.TaskWrapper'):
-        handler = AddRealityHandler(task_wrapper.task.user_data)
-        handler.authorization()
+    def renew_tasks(self) -> None:
+        """
+        Extend the claims of tasks held by this processor on the workers and schedule the next heartbeat.
+        """
+        self.pool.submit(('task-queue',), self.tasks_queue.renew)
+        self.scheduler.schedule(
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=self.config.queue_lease / 3), self.renew_tasks)
 
-        campaigns_to_delete = handler.get_device_info(task_wrapper.task.device_id)
-        if task_wrapper.switch_to is True:
-            content_id = handler.get_content_id(task_wrapper.task.name)
-            if not content_id:
-                handler.add_content(task_wrapper.task.name)
-                content_id = handler.get_content_id(task_wrapper.task.name)
-                if not content_id:
-                    return
+    def refresh_device_states(self) -> None:
+        """
+        Refresh device state of every platform with a live session on the workers and schedule the next refresh.
+        Devices with a slot booked or a switch pending are refreshed along with the devices read recently.
+        """
+        booked: dict[int, set[int]] = {}
+        with self._bookings_lock:
+            task_wrappers = [booking.task_wrapper for booking in self.bookings.values()]
+        with self._pending_lock:
+            task_wrappers += [task_wrapper for task_wrapper, _ in self._pending.values()]
+        for task_wrapper in task_wrappers:
+            booked.setdefault(task_wrapper.task.user_data.platform_id, set()).add(task_wrapper.task.device_id)
+        for handler in self.sessions.platform_handlers():
+            key = ('device-state', handler.platform_id)
+            if key not in self._refreshing:
+                self._refreshing.add(key)
+                self.pool.submit(key, self.refresh_device_state, key, handler, booked.get(handler.platform_id, ()))
+        self.scheduler.schedule(
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=self.sessions.config.device_state_refresh_interval),
+            self.refresh_device_states)
 
-            received_time = task_wrapper.task.from_time
+    def refresh_device_state(self, key: tuple[str, int], handler: 'AddRealityHandler', device_ids: set[int]) -> None:
+        try:
+            handler.refresh_device_state(device_ids)
+        finally:
+            self._refreshing.discard(key)
 
-            while received_time > datetime.datetime.utcnow() + datetime.timedelta(seconds=1):
-                time.sleep(.25)
+    def prepare(self, task_wrapper: 'dc.TaskWrapper') -> Optional[int]:
+        """
+        Find or upload content of the task ahead of time, so only the campaign swap is left at from_time.
+        :return: content_id or None if content is not available
+        """
+        if task_wrapper.superseded_by is not None:
+            return None
+        task_wrapper.readiness = dc.Readiness.PREPARING
+        try:
+            with task_wrapper.stage('auth'):
+                handler = self.sessions.get(task_wrapper.task.user_data)
+            content_id = handler.add_content(task_wrapper.task.name, task_wrapper.stage)
+        except Exception as ex:
+            self.logger.exception(f'Task {task_wrapper.id}: content {task_wrapper.task.name} is not prepared: {ex!r}')
+            content_id = None
 
-            handler.delete_campaigns(campaigns_to_delete)
-            created_campaign = campaign_generator.create_campaign(content_id, task_wrapper.task)
-            handler.add_and_start_campaign(created_campaign)
+        if task_wrapper.superseded_by is not None:
+            task_wrapper.readiness = dc.Readiness.SUPERSEDED
+        elif not content_id:
+            task_wrapper.readiness = dc.Readiness.FAILED
+            self.logger.error(f'Task {task_wrapper.id}: content {task_wrapper.task.name} is not available')
+            return None
         else:
-            handler.delete_campaigns(campaigns_to_delete)
+            task_wrapper.readiness = dc.Readiness.READY
+        return content_id
+
+    def switch(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        with self._pending_lock:
+            # a newer task has replaced this one while it was waiting for a worker
+            if task_wrapper.superseded_by is not None:
+                return
+            key = self.pending_key(task_wrapper)
+            if self._pending.get(key, (None,))[0] is task_wrapper:
+                del self._pending[key]
+
+        step = 'content'
+        try:
+            # content upload started at accepting could still be running if the slot is close, retries prepare again
+            future = self._prepared.pop(task_wrapper.id, None)
+            content_id = future.result() if future is not None else self.prepare(task_wrapper)
+            if task_wrapper.superseded_by is not None:
+                return
+            if content_id is None:
+                raise exceptions.AddRealityError(f'Content {task_wrapper.task.name} is not available')
+
+            step = 'create'
+            with task_wrapper.stage('auth'):
+                handler = self.sessions.get(task_wrapper.task.user_data)
+            # the name made from task id is the idempotency key of the campaign
+            created_campaign = campaign_generator.create_campaign(content_id, task_wrapper.task, task_wrapper.id)
+            campaign_id = None
+            if task_wrapper.attempts.get('create') or task_wrapper.deliveries > 1:
+                # a failed attempt or the processor before restart could have created the campaign
+                with task_wrapper.stage('create'):
+                    campaign_id = handler.find_campaign(created_campaign['name'])
+            if self.config.atomic_swap:
+                with task_wrapper.stage('create'):
+                    task_wrapper.campaign_id = campaign_id or handler.create_campaign(created_campaign)
+            else:
+                step = 'delete'
+                with task_wrapper.stage('delete'):
+                    campaigns_to_delete = [
+                        campaign_id_ for campaign_id_ in handler.get_device_info(task_wrapper.task.device_id)
+                        if campaign_id_ != campaign_id
+                    ]
+                    handler.delete_campaigns(campaigns_to_delete)
+                stopped_at = time.monotonic()
+                step = 'create'
+                # the campaign is created already playing, so its creation is the start stage
+                with task_wrapper.stage('start'):
+                    if campaign_id is None:
+                        campaign_id = handler.add_and_start_campaign(created_campaign)
+                    else:
+                        handler.start_campaign(campaign_id)
+                task_wrapper.campaign_id = campaign_id
+        except Exception as ex:
+            self.retry(task_wrapper, step, self.switch, ex)
+            return
+
+        if self.config.atomic_swap:
+            run_at = datetime.datetime.utcnow()
+            if task_wrapper.task.from_time is not None:
+                run_at = task_wrapper.task.from_time - datetime.timedelta(seconds=self.config.switch_lead)
+            self.scheduler.schedule(
+                run_at, self.pool.submit, task_wrapper.task.device_id, self.swap, task_wrapper)
+            return
+        self.record_start(task_wrapper, time.monotonic() - stopped_at if campaigns_to_delete else None)
+
+    def swap(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        """
+        Start the campaign created ahead of from_time, then remove the other campaigns of the device.
+        """
+        try:
+            with task_wrapper.stage('auth'):
+                handler = self.sessions.get(task_wrapper.task.user_data)
+            with task_wrapper.stage('delete'):
+                campaigns_to_delete = [
+                    campaign_id for campaign_id in handler.get_device_info(task_wrapper.task.device_id)
+                    if campaign_id != task_wrapper.campaign_id
+                ]
+            # start_campaign raises unless the campaign plays, the old ones are kept till then
+            with task_wrapper.stage('start'):
+                handler.start_campaign(task_wrapper.campaign_id)
+            started_at = time.monotonic()
+            with task_wrapper.stage('delete'):
+                handler.delete_campaigns(campaigns_to_delete)
+        except Exception as ex:
+            self.retry(task_wrapper, 'swap', self.swap, ex)
+            return
+        self.record_start(task_wrapper, started_at - time.monotonic() if campaigns_to_delete else None)
+
+    def record_start(self, task_wrapper: 'dc.TaskWrapper', swap_gap: Optional[float]) -> None:
+        """
+        :param swap_gap: seconds the device has had no campaign, None if there was nothing to replace
+        """
+        task_wrapper.status = 'started'
+        task_wrapper.started_at = datetime.datetime.utcnow()
+        task_wrapper.swap_gap = swap_gap
+        if swap_gap is not None:
+            swap_gap_histogram.observe(swap_gap)
+        if task_wrapper.task.from_time is not None:
+            task_wrapper.start_skew = (datetime.datetime.utcnow() - task_wrapper.task.from_time).total_seconds()
+            start_skew_histogram.observe(task_wrapper.start_skew)
+        try:
+            self.tasks_queue.record_start(task_wrapper)
+        except Exception as ex:
+            self.logger.exception(f'Task {task_wrapper.id}: start is not stored: {ex!r}')
+        self.started(task_wrapper)
+        self.logger.info(
+            f'Task {task_wrapper.id}: device {task_wrapper.task.device_id} started'
+            + (f' with skew {task_wrapper.start_skew:+.3f}s' if task_wrapper.start_skew is not None else '')
+            + (f', gap {swap_gap:+.3f}s' if swap_gap is not None else ''))
+
+    def started(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        """
+        Complete the tasks whose slot has been taken over by the started one,
+        and the started one itself if it has no turn-off left.
+        """
+        with self._bookings_lock:
+            booking = self.bookings.get(task_wrapper.task.device_id)
+            taken_over = []
+            if booking is not None and booking.task_wrapper is task_wrapper:
+                taken_over, booking.taken_over = booking.taken_over, []
+        for previous in taken_over:
+            self.complete(previous, 'done')
+        if task_wrapper.task.to_time is None:
+            self.complete(task_wrapper, 'done')
+
+    def turn_off(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        try:
+            with task_wrapper.stage('auth'):
+                handler = self.sessions.get(task_wrapper.task.user_data)
+            with task_wrapper.stage('delete'):
+                campaigns_to_delete = handler.get_device_info(task_wrapper.task.device_id)
+                handler.delete_campaigns(campaigns_to_delete)
+        except Exception as ex:
+            self.retry(task_wrapper, 'turn_off', self.turn_off, ex)
+            return
+        self.complete(task_wrapper, 'done')
+
+    def retry(
+            self,
+            task_wrapper: 'dc.TaskWrapper',
+            step: str,
+            fn: Callable[['dc.TaskWrapper'], None],
+            ex: Exception,
+    ) -> None:
+        """
+        Run fn of the task again on the workers after the delay of the retry policy of step,
+        move the task to dead letters when the retries are over. Called from the except block of the step.
+        :param step: content, delete, create, swap or turn_off
+        :param fn: method of the step which has failed
+        :param ex: error of the step
+        """
+        attempt = task_wrapper.attempts.get(step, 0) + 1
+        task_wrapper.attempts[step] = attempt
+        task_wrapper.error = f'{step}: {ex!r}'
+        if task_wrapper.superseded_by is not None:
+            return
+        policy = self.config.retry_policy(step)
+        if attempt > policy.retries:
+            self.logger.exception(f'Task {task_wrapper.id}: {step} has failed {attempt} times, moved to dead letters')
+            self.dead_letter(task_wrapper, step)
+            return
+        delay = policy.delay_of(attempt)
+        registry.counter(
+            'ad_processor_step_retries_total', 'Steps of tasks run again after an error', step=step).inc()
+        self.logger.warning(f'Task {task_wrapper.id}: {step} has failed: {ex!r}, retry in {delay:.1f}s', exc_info=True)
+        self.scheduler.schedule(
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=delay),
+            self.pool.submit, task_wrapper.task.device_id, fn, task_wrapper)
+
+    def dead_letter(self, task_wrapper: 'dc.TaskWrapper', step: str) -> None:
+        with self._tasks_lock:
+            if task_wrapper.status in TERMINAL_STATUSES:
+                return
+            task_wrapper.status = 'dead'
+            task_wrapper.completed_at = datetime.datetime.utcnow()
+        task_wrapper.readiness = dc.Readiness.DEAD
+        registry.counter(
+            'ad_processor_dead_letters_total', 'Tasks failed after all retries of a step', step=step).inc()
+        try:
+            self.tasks_queue.dead_letter(task_wrapper, task_wrapper.error)
+        except Exception as ex:
+            self.logger.exception(f'Task {task_wrapper.id}: dead letter is not stored: {ex!r}')
+        self.drop_booking(task_wrapper)
+        if task_wrapper.switch_to is True and task_wrapper.campaign_id is not None:
+            self.pool.submit(task_wrapper.task.device_id, self.discard_campaign, task_wrapper)
+
+    def discard_campaign(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        """
+        Delete the campaign of dead-lettered task whatever its status, nothing would turn it off later.
+        A failure is only logged, the task is in dead letters already.
+        """
+        try:
+            handler = self.sessions.get(task_wrapper.task.user_data)
+            handler.delete_campaigns([task_wrapper.campaign_id], only_playing=False)
+        except Exception as ex:
+            self.logger.exception(
+                f'Task {task_wrapper.id}: campaign {task_wrapper.campaign_id} is not deleted: {ex!r}')
+
+    def drop_booking(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        """
+        Remove the slot of turn-on task which will never start. The slots it has taken over are over,
+        the tasks merged into it are accepted again to play on their own.
+        """
+        with self._bookings_lock:
+            booking = self.bookings.get(task_wrapper.task.device_id)
+            if booking is None or booking.task_wrapper is not task_wrapper:
+                return
+            del self.bookings[task_wrapper.task.device_id]
+            if booking.turn_off_job is not None:
+                booking.turn_off_job.cancel()
+        for previous in booking.taken_over:
+            self.pool.submit(previous.task.device_id, self.end_slot, previous)
+        for merged in booking.merged:
+            merged.readiness = dc.Readiness.PENDING
+            self.accept(merged)
@@ -6,6 +6,13 @@ from typing import Any, Optional
 import yaml
 import app.data_classes as dc
 from app.db_controller import DBController, WithSessionContextManager
+from app.metrics import registry
+from app.ttl_cache import TTLCache
+
+publisher_cache_hits = registry.counter(
+    'publisher_cache_hits_total', 'Publisher credentials served from memory')
+publisher_cache_misses = registry.counter(
+    'publisher_cache_misses_total', 'Publisher credentials fetched from the DB')
 
 
 class AddRealityContext:
@@ -32,7 +39,21 @@ class AddRealityContext:
                     os.mkdir(folder)
         db: dict[str, Any] = self.config['db']
         self.db_config = dc.DBConfig(**db)
+        add_reality: dict[str, Any] = self.config.get('add_reality') or {}
+        self.add_reality_config = dc.AddRealityConfig(**add_reality)
+        self.add_reality_config.upload_journal_path = path.join(
+            self.project_path, self.add_reality_config.upload_journal_path)
+        self.add_reality_config.content_store_path = path.join(
+            self.project_path, self.add_reality_config.content_store_path)
+        api: dict[str, Any] = self.config.get('api') or {}
+        self.api_config = dc.APIConfig(**api)
+        processor: dict[str, Any] = self.config.get('processor') or {}
+        self.processor_config = dc.ProcessorConfig(**processor)
         self.secret_key = self.config['secret_key']
+        # decrypted credentials by device_id, filled by MS, every read is counted
+        self.publishers_cache: TTLCache['dc.User'] = TTLCache(
+            self.api_config.publisher_cache_size, self.api_config.publisher_cache_ttl,
+            publisher_cache_hits, publisher_cache_misses)
 
     def load_db_controller(self) -> 'DBController':
         if self.__db_controller is None:
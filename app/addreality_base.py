@@ -0,0 +1,348 @@
+import contextlib
+import math
+import os
+import re
+import time
+from typing import Any, ContextManager, Optional
+from urllib.parse import urlsplit
+
+from app import data_classes as dc, exceptions, rate_limiter
+from app.content_catalog import ContentCatalog
+from app.content_store import ContentStore
+from app.device_state import DeviceState
+from app.metrics import registry
+from app.upload_journal import UploadJournal
+import app.log_lib as log_lib
+
+reauth_counter = registry.counter(
+    'addreality_reauth_total', 'Logins repeated for an expired or rejected AddReality session')
+uploaded_bytes_counter = registry.counter(
+    'addreality_uploaded_bytes_total', 'Bytes of media files uploaded to AddReality')
+deduplicated_counter = registry.counter(
+    'addreality_content_deduplicated_total', 'Media files not uploaded because identical bytes are already stored')
+upload_throughput_histogram = registry.histogram(
+    'addreality_upload_throughput_mbps', 'Throughput of media file uploads in MB/s',
+    buckets=(.25, .5, 1., 2., 5., 10., 20., 50., 100.),
+)
+request_buckets = (.05, .1, .25, .5, 1., 2.5, 5., 10., 30.)
+
+
+def count_request_error(method: str, endpoint: str, status: str) -> None:
+    """
+    :param status: status code of the response at or above 400, or error if no response has been received
+    """
+    registry.counter(
+        'addreality_request_errors_total', 'Requests to AddReality failed with an error status or no response',
+        method=method, endpoint=endpoint, status=status,
+    ).inc()
+
+
+def endpoint_of(url: str) -> str:
+    """Path of url with ids replaced by a placeholder, so requests to one endpoint share a histogram."""
+    return re.sub(r'/\d+(?=/|$)', '/{id}', urlsplit(url).path)
+
+
+def no_stage(name: str) -> ContextManager:
+    """Stage timer of add_content when the caller does not time stages."""
+    return contextlib.nullcontext()
+
+
+class BaseAddRealityHandler:
+    """
+    Session and shared state of an AddReality account with the decisions made on responses:
+    what is cached in the device state, content store and catalog, what counts as a failure.
+    AddRealityHandler and AsyncAddRealityHandler only send the requests.
+    """
+    __logger: 'log_lib' = None
+    # errors of a request which has got no response
+    network_errors: tuple[type[BaseException], ...] = ()
+
+    def __init__(
+            self,
+            user: 'dc.User',
+            config: Optional['dc.AddRealityConfig'] = None,
+            content_catalog: Optional['ContentCatalog'] = None,
+            content_store: Optional['ContentStore'] = None,
+            device_state: Optional['DeviceState'] = None,
+    ):
+        self.data = {'login': user.login, 'password': user.password}
+        self.platform_id = user.platform_id
+
+        self.headers = {
+            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 (KHTML, like Gecko) "
+                          "Chrome/83.0.4103.97 Safari/537.36"
+        }
+
+        self.config = config or dc.AddRealityConfig()
+        self.api_url = self.config.api_url.rstrip('/')
+        # rate limits shared by all sessions of the account and by all accounts
+        self.throttle = rate_limiter.throttle_of(self.config, self.platform_id, user.login)
+        # a standalone handler keeps its session until the server rejects it
+        self.session_ttl = config.session_ttl if config else None
+        self.authorized_at: Optional[float] = None
+        self._auth_generation = 0
+
+        # catalog is shared by all sessions of the platform
+        self.content_catalog = content_catalog or ContentCatalog(self.platform_id, 0)
+        # digest → content_id index shared by all sessions
+        self.content_store = content_store or ContentStore()
+
+        # campaigns of devices and their statuses shared by all sessions of the platform
+        self.device_state = device_state or DeviceState(
+            self.platform_id, self.config.device_state_max_age, self.config.device_state_idle)
+
+    @property
+    def logger(self) -> 'log_lib.Logger':
+        if self.__logger is None:
+            self.__logger = log_lib.get_logger(self.__class__.__name__)
+        return self.__logger
+
+    @property
+    def is_authorized(self) -> bool:
+        """
+        Whether the session has logged in and its TTL has not run out yet.
+        :return: bool
+        """
+        if self.authorized_at is None:
+            return False
+        if self.session_ttl is None:
+            return True
+        return time.monotonic() - self.authorized_at < self.session_ttl
+
+    @staticmethod
+    def _status(response: Any) -> int:
+        raise NotImplementedError
+
+    @staticmethod
+    def _json(response: Any) -> Any:
+        raise NotImplementedError
+
+    def _raise_for_status(self, response: Any, message: str) -> None:
+        """
+        :param message: what has failed
+        :raise AddRealityError: if status of the response is an error
+        """
+        status = self._status(response)
+        if status >= 400:
+            raise exceptions.AddRealityError(f'{message}: status {status}')
+
+    def _check_login(self, response: Any) -> None:
+        """
+        :raise AddRealityError: if a step of the login has been rejected, the session is not authorized then
+        """
+        status = self._status(response)
+        if status != 200:
+            self.logger.critical(f"The user isn't authorized")
+            self.authorized_at = None
+            raise exceptions.AddRealityError(f'Login has failed with status {status}')
+
+    def _authorized(self) -> None:
+        self.authorized_at = time.monotonic()
+        self._auth_generation += 1
+        self.logger.info(f"The user is authorized")
+
+    def _store_device_campaigns(self, device_id: int, response: Any, version: int) -> list[int]:
+        """
+        :param version: device_version read before the request
+        :return: ids of campaigns of the device
+        """
+        # an error body has no campaigns, it must not be cached as an empty device
+        self._raise_for_status(response, f'Device {device_id} has not been received')
+        campaign_ids = [campaign['id'] for campaign in self._json(response).get('campaigns', [])]
+        self.device_state.put_campaigns(device_id, campaign_ids, version)
+        return campaign_ids
+
+    def _store_statuses(self, response: Any, version: int) -> dict[int, str]:
+        """
+        :param version: statuses_version read before the request
+        :return: status by campaign id
+        """
+        self._raise_for_status(response, 'Campaign listing has not been received')
+        statuses = {campaign['id']: campaign['status'] for campaign in self._json(response)['campaigns']}
+        self.device_state.put_statuses(statuses, version)
+        return statuses
+
+    def _campaign_named(self, response: Any, name: str) -> Optional[int]:
+        """
+        :param response: campaign listing
+        :return: id of campaign with the name or None
+        """
+        self._raise_for_status(response, 'Campaign listing has not been received')
+        for campaign in self._json(response)['campaigns']:
+            if campaign.get('name') == name:
+                return campaign['id']
+        return None
+
+    def _content_listing(self, response: Any) -> list[tuple[str, int]]:
+        self._raise_for_status(response, 'Content listing has not been received')
+        res = [(entity['name'], entity['id']) for entity in self._json(response)['content']]
+        self.logger.info(f"Received content: {len(res)} files")
+        return res
+
+    def _stored_content_id(self, digest: str) -> Optional[int]:
+        return self.content_store.get(digest, self.platform_id)
+
+    def _forget_content(self, digest: str) -> None:
+        # content has been removed from the storage
+        self.content_store.forget(digest, self.platform_id)
+
+    def _content_added(self, digest: str, file_name: str, content_id: Optional[int], uploaded: bool) -> None:
+        """
+        Remember the content of a new upload, count the file found already stored.
+        """
+        if not uploaded:
+            deduplicated_counter.inc()
+            self.logger.info(f"{file_name} already added as {content_id}")
+        elif content_id is not None:
+            self.content_store.put(digest, self.platform_id, content_id)
+
+    def _upload_data(self, file_path: str, file_name: str) -> dict:
+        """
+        :return: form fields of upload request
+        """
+        return {
+            'name': file_name,
+            'group_id': 0,
+            'size': os.path.getsize(file_path),
+            'decode': True,
+        }
+
+    def _upload_journal(self, file_path: str) -> 'UploadJournal':
+        return UploadJournal(self.config.upload_journal_path, self.platform_id, file_path, self.config.chunk_size)
+
+    def _upload_finished(self, data_: dict, started: float) -> None:
+        size = data_['size']
+        elapsed = time.monotonic() - started
+        throughput = size / 1_000_000 / elapsed if elapsed else 0.
+        upload_throughput_histogram.observe(throughput)
+        self.logger.info(f"{data_['name']} has been uploaded: {size / 1_000_000:.1f} MB "
+                         f"in {elapsed:.1f}s, {throughput:.2f} MB/s")
+
+    def _chunks_left(self, data_: dict, journal: 'UploadJournal') -> tuple[int, list[int]]:
+        """
+        :return: number of chunks of the file and the chunks between the first and the last one not acknowledged
+        """
+        chunks = math.ceil(data_['size'] / self.config.chunk_size)
+        self.logger.info(f"Uploading object by {chunks} chunks, {len(journal.acked)} already uploaded")
+        return chunks, [i for i in range(1, chunks - 1) if i not in journal.acked]
+
+    def _upload_started(self, response: Any, data_: dict, journal: 'UploadJournal') -> None:
+        """Record file_id of the upload session opened by the first chunk."""
+        try:
+            file_id = self._json(response)['file_id']
+        except (ValueError, KeyError, TypeError):
+            raise exceptions.AddRealityError(f'Upload of {data_["name"]} has not been started')
+        journal.ack(0, file_id)
+
+    def _chunk_data(self, data_: dict, index: int, with_offset: bool) -> dict:
+        return {**data_, 'offset': index * self.config.chunk_size} if with_offset else data_
+
+    def _chunk_retry_delay(self, attempt: int) -> float:
+        return self.config.chunk_retry_delay * 2 ** (attempt - 1) if attempt else 0.
+
+    def _chunk_uploaded(self, response: Any, size: int) -> Optional[str]:
+        """
+        :return: None if the chunk has been accepted, otherwise the error to retry it on
+        """
+        status = self._status(response)
+        if status >= 400:
+            return f'status {status}'
+        uploaded_bytes_counter.inc(size)
+        return None
+
+    def _uploaded_content_id(self, file_name: str, response: Any) -> Optional[int]:
+        """
+        Put id of uploaded file into the content catalog.
+        :return: id from the upload response, None if it doesn't carry one and the listing has to be fetched
+        """
+        with contextlib.suppress(ValueError, AttributeError, TypeError):
+            payload = self._json(response)
+            content_id = payload.get('content_id') or payload.get('id')
+            if content_id:
+                self.content_catalog.add(file_name, content_id)
+                return content_id
+        return None
+
+    def _new_content_id(self, file_name: str, before: set[int], listing: list[tuple[str, int]]) -> Optional[int]:
+        """
+        Find the uploaded file in the listing fetched after the upload. A changed file keeps its name,
+        so the name may be taken by older content, the id is the one the name didn't have before the upload.
+        :param before: ids of content with the name before the upload
+        :return: content_id or None if the file is not in the listing
+        """
+        self.content_catalog.replace(listing)
+        candidates = [content_id for name, content_id in listing if name == file_name and content_id not in before]
+        if not candidates:
+            return None
+        if len(candidates) > 1:
+            self.logger.warning(f"{file_name} has been uploaded {len(candidates)} times meanwhile, "
+                                f"the latest one is taken")
+        content_id = max(candidates)
+        self.content_catalog.add(file_name, content_id)
+        return content_id
+
+    def _campaigns_to_delete(self, campaign_ids: list[int], statuses: dict[int, str]) -> list[int]:
+        """
+        :param statuses: status by campaign id from the listing
+        :return: playing campaigns among campaign_ids, campaigns missing from the listing are skipped
+        """
+        playing = []
+        for campaign_id in campaign_ids:
+            status = statuses.get(campaign_id)
+            if status is None:
+                self.logger.warning(f"Campaign {campaign_id} is not in the listing, skipping it")
+            elif status == 'playing':
+                playing.append(campaign_id)
+        return playing
+
+    @staticmethod
+    def _raise_delete_errors(errors: dict[int, BaseException]) -> None:
+        if errors:
+            raise exceptions.AddRealityError(
+                f"Campaigns have not been deleted: {', '.join(f'{k}: {v!r}' for k, v in errors.items())}")
+
+    def _delete_step_done(self, method: str, response: Any) -> bool:
+        """
+        :return: True if the campaign is already gone on the server, so the next steps are skipped
+        :raise AddRealityError: if the step has failed
+        """
+        status = self._status(response)
+        if status == 404:
+            return True
+        if status >= 400:
+            raise exceptions.AddRealityError(f'{method} status {status}')
+        return False
+
+    def _campaign_payload(self, created_campaign: dict, status: Optional[str]) -> dict:
+        """
+        :return: body of the campaign creation, only compact mode carries the status
+        """
+        if self.config.campaign_create_mode == 'compact' and status:
+            return {**created_campaign, 'status': status}
+        return created_campaign
+
+    def _created_campaign(self, response: Any) -> dict:
+        """
+        :return: campaign of the creation response, empty if there is no id to take from it
+        """
+        if response is None or self._status(response) >= 400:
+            return {}
+        campaign = self._json(response)
+        return campaign if isinstance(campaign, dict) else {}
+
+    def _campaign_created(
+            self,
+            campaign_id: int,
+            created_campaign: dict,
+            campaign: dict,
+            status: Optional[str],
+    ) -> bool:
+        """
+        Record the new campaign in the device state.
+        :return: True if the campaign still has to be started
+        """
+        self.device_state.add_campaign(
+            campaign_id, created_campaign.get('devices_delta', {}).get('selected', []),
+            campaign.get('status') or 'paused')
+        # status is not accepted on creation in full mode or has been ignored by the server
+        return status == 'playing' and campaign.get('status') != status
@@ -1,32 +1,126 @@
-import os
+import json
 import pathlib
-from typing import Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, ContextManager, Iterable, Optional
 
 import requests
-import json
-
-from app import data_classes as dc, utils
-import app.log_lib as log_lib
-
-
-class AddRealityHandler:
-    __logger: 'log_lib' = None
-
-    def __init__(self, user: 'dc.User'):
-        self.session = requests.session()
-        self.data = {'login': user.login, 'password': user.password}
-        self.platform_id = user.platform_id
 
-        self.headers = {
-            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 (KHTML, like Gecko) "
-                          "Chrome/83.0.4103.97 Safari/537.36"
-        }
-
-    @property
-    def logger(self) -> 'log_lib.Logger':
-        if self.__logger is None:
-            self.__logger = log_lib.get_logger(self.__class__.__name__)
-        return self.__logger
+from app import data_classes as dc, exceptions, transport
+from app.addreality_base import (
+    BaseAddRealityHandler,
+    count_request_error,
+    endpoint_of,
+    no_stage,
+    reauth_counter,
+    request_buckets,
+    uploaded_bytes_counter,
+)
+from app.content_catalog import ContentCatalog
+from app.content_store import ContentStore
+from app.device_state import DeviceState
+from app.metrics import registry
+from app.upload_journal import UploadJournal
+
+
+class AddRealityHandler(BaseAddRealityHandler):
+    network_errors = (requests.RequestException,)
+
+    def __init__(
+            self,
+            user: 'dc.User',
+            config: Optional['dc.AddRealityConfig'] = None,
+            content_catalog: Optional['ContentCatalog'] = None,
+            content_store: Optional['ContentStore'] = None,
+            device_state: Optional['DeviceState'] = None,
+    ):
+        super().__init__(user, config, content_catalog, content_store, device_state)
+        self.session = transport.new_session(self.config)
+        self.timeout = (self.config.connect_timeout, self.config.read_timeout)
+        self._auth_lock = threading.Lock()
+        # concurrent switches of the account wait for a single campaign listing
+        self._campaigns_lock = threading.Lock()
+
+    @staticmethod
+    def _status(response: 'requests.Response') -> int:
+        return response.status_code
+
+    @staticmethod
+    def _json(response: 'requests.Response'):
+        return response.json()
+
+    def ensure_authorized(self) -> bool:
+        """
+        Log in unless the session is still authorized. Safe to call from several threads.
+        :return: True if the login handshake has been performed
+        """
+        with self._auth_lock:
+            if self.is_authorized:
+                return False
+            if self.authorized_at is not None:
+                reauth_counter.inc()
+            self.authorization()
+            return True
+
+    def _reauthorize(self, generation: int) -> None:
+        with self._auth_lock:
+            # another thread has already logged in again after our request was sent
+            if generation != self._auth_generation:
+                return
+            self.logger.info('Session has been rejected, authorizing again')
+            reauth_counter.inc()
+            self.authorization()
+
+    def _send(self, method: str, url: str, **kwargs) -> 'requests.Response':
+        """
+        Send request with default headers and timeouts within the rate limits, its latency is recorded per endpoint.
+        Responses 429 and 5xx are repeated with backoff.
+        :param method: HTTP method
+        :param url: full url of endpoint
+        :return: requests.Response
+        """
+        kwargs.setdefault('headers', self.headers)
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = endpoint_of(url)
+        histogram = registry.histogram(
+            'addreality_request_seconds', 'Latency of requests to AddReality API',
+            buckets=request_buckets, method=method, endpoint=endpoint,
+        )
+        attempt = 0
+        while True:
+            time.sleep(self.throttle.reserve())
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except self.network_errors:
+                count_request_error(method, endpoint, 'error')
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+            if response.status_code >= 400:
+                count_request_error(method, endpoint, str(response.status_code))
+            delay = self.throttle.retry_delay(
+                method, response.status_code, attempt, response.headers.get('Retry-After'))
+            if delay is None:
+                return response
+            self.logger.warning(f'{method} {endpoint}: status {response.status_code}, retry in {delay:.2f}s')
+            time.sleep(delay)
+            attempt += 1
+
+    def _request(self, method: str, url: str, **kwargs) -> 'requests.Response':
+        """
+        Send request within the authorized session, log in again once if the server has rejected the session.
+        :param method: HTTP method
+        :param url: full url of endpoint
+        :return: requests.Response
+        """
+        generation = self._auth_generation
+        response = self._send(method, url, **kwargs)
+        if response.status_code == 401 and self.authorized_at is not None:
+            self._reauthorize(generation)
+            response = self._send(method, url, **kwargs)
+        return response
 
     def reload_player(self, device_id: int) -> None:
         """
@@ -37,22 +131,29 @@ class AddRealityHandler:
         self.logger.info('Reloading player')
         with open('./payload.json') as json_file:
             reload_data = json.load(json_file)
-        self.session.put(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/devices/{device_id}',
-            headers=self.headers,
+        self._request(
+            'PUT',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/devices/{device_id}',
             data=json.dumps(reload_data))
         self.logger.info('Player has been reloaded')
 
-    def get_device_info(self, device_id: int):
-        r_device_info = self.session.get(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/devices/{device_id}',
-            headers=self.headers
-        )
-        list_of_campaigns_id = []
-        device_campaigns = r_device_info.json().get('campaigns', [])
-        for device in device_campaigns:
-            list_of_campaigns_id.append(device['id'])
-        return list_of_campaigns_id
+    def get_device_info(self, device_id: int, force: bool = False) -> list[int]:
+        """
+        Get ids of campaigns of the device, from the device state if it is fresh.
+        :param device_id: id of device
+        :param force: fetch campaigns even if the device state is fresh
+        :raise AddRealityError: if the device has not been received
+        :return: list[int]
+        """
+        campaign_ids = None if force else self.device_state.get_campaigns(device_id)
+        if campaign_ids is None:
+            version = self.device_state.device_version(device_id)
+            r_device_info = self._request(
+                'GET',
+                f'{self.api_url}/v5/platforms/{self.platform_id}/devices/{device_id}'
+            )
+            campaign_ids = self._store_device_campaigns(device_id, r_device_info, version)
+        return campaign_ids
 
     def get_devices(self) -> list['dc.Device']:
         """
@@ -60,9 +161,9 @@ class AddRealityHandler:
         :return: list['dc.Device']
         """
         self.logger.info("Receiving devices")
-        r_existed_devices = self.session.get(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/devices',
-            headers=self.headers
+        r_existed_devices = self._request(
+            'GET',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/devices'
         )
         res = [
             dc.Device(
@@ -75,44 +176,45 @@ class AddRealityHandler:
     def authorization(self) -> None:
         """
         Authorize user in api.
+        :raise AddRealityError: if the login has been rejected
         :return: None
         """
         self.logger.info(f"Authorizing user...")
 
         # start authorizing session
-        r_start_auth = self.session.post(
-            'https://api.ar.digital/v5/auth/login/multi_step/start',
-            headers=self.headers,
+        r_start_auth = self._send(
+            'POST',
+            f'{self.api_url}/v5/auth/login/multi_step/start',
             data=self.data
         )
+        self._check_login(r_start_auth)
         self.data['session_id'] = r_start_auth.json()['session_id']
 
         # send request with login
-        r_post_login = self.session.post(
-            'https://api.ar.digital/v5/auth/login/multi_step/check_login',
-            headers=self.headers,
+        r_post_login = self._send(
+            'POST',
+            f'{self.api_url}/v5/auth/login/multi_step/check_login',
             data=json.dumps(self.data)
         )
 
         # send request with password
-        r_post_pass = self.session.post(
-            'https://api.ar.digital/v5/auth/login/multi_step/commit_pwd',
-            headers=self.headers,
+        r_post_pass = self._send(
+            'POST',
+            f'{self.api_url}/v5/auth/login/multi_step/commit_pwd',
             data=json.dumps(self.data)
         )
 
         # end authorizing session
-        r_end_auth = self.session.post(
-            'https://api.ar.digital/v5/auth/login/multi_step/finish',
-            headers=self.headers,
+        r_end_auth = self._send(
+            'POST',
+            f'{self.api_url}/v5/auth/login/multi_step/finish',
             data=json.dumps(self.data)
         )
-        self.headers.update({'Referrer Policy': 'strict-origin-when-cross-origin'})
+        self.headers.update({'Referrer-Policy': 'strict-origin-when-cross-origin'})
 
         for resp in [r_post_login, r_post_pass, r_end_auth]:
-            if resp.status_code != 200:
-                self.logger.critical(f"The user isn't authorized")
-        self.logger.info(f"The user is authorized")
+            self._check_login(resp)
+        self._authorized()
 
     def pause_campaign(self, campaign_id) -> None:
         """
@@ -123,128 +225,212 @@ class AddRealityHandler:
         pause_ping = {
             'status': 'paused'
         }
-        self.session.put(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/campaign/{campaign_id}',
-            headers=self.headers,
+        self._request(
+            'PUT',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/{campaign_id}',
             data=json.dumps(pause_ping)
         )
         self.logger.info(f"Campaign {campaign_id} has been paused")
+        self.device_state.set_status(campaign_id, 'paused')
 
     def start_campaign(self, campaign_id: int) -> None:
         """
         Play the advertising campaign.
         :param campaign_id: id of campaign
+        :raise AddRealityError: if the campaign has not been started
         :return: None
         """
         play_ping = {
             'status': 'playing'
         }
-        self.session.put(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/campaign/{campaign_id}',
-            headers=self.headers,
+        r_start = self._request(
+            'PUT',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/{campaign_id}',
             data=json.dumps(play_ping)
         )
+        self._raise_for_status(r_start, f'Campaign {campaign_id} has not been started')
         self.logger.info(f"Campaign {campaign_id} has been started")
+        self.device_state.set_status(campaign_id, 'playing')
 
-    def get_content_id(self, file_path: str) -> Optional[int]:
+    def get_content_listing(self) -> list[tuple[str, int]]:
         """
-        Get id of media file.
-        :param file_path: path to media file on server
-        :return: None
+        Get names and ids of all media files in storage.
+        :return: list[tuple[str, int]]
         """
         self.logger.info(f"Receiving content from storage...")
-
-        # get filename form file path
-        file_name = pathlib.Path(file_path).name
-
-        r_uploaded_content = self.session.get(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/content/groups/0?',
-            headers=self.headers,
+        r_uploaded_content = self._request(
+            'GET',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/content/groups/0?',
             data=self.data,
         )
-        res = {}
-        for entity in r_uploaded_content.json()['content']:
-            res[entity['name']] = entity['id']
-
-        self.logger.info(f"Received content: {res}")
+        return self._content_listing(r_uploaded_content)
 
-        return res.get(file_name)
+    def get_content_id(self, file_path: str) -> Optional[int]:
+        """
+        Get id of media file from the content catalog of platform.
+        :param file_path: path to media file on server
+        :return: id of media file or None
+        """
+        # get filename form file path
+        file_name = pathlib.Path(file_path).name
+        return self.content_catalog.lookup(file_name, self.get_content_listing)
 
-    def add_content(self, file_path: str) -> None:
+    def add_content(self, file_path: str, stage: Callable[[str], ContextManager] = no_stage) -> Optional[int]:
         """
-        Add media file to storage if it doesn't already exist there.
+        Add media file to storage unless a file with the same contents has already been uploaded to the platform.
         :param file_path: path to media file on server
-        :return: None
+        :param stage: timer of the content_lookup and upload stages, TaskWrapper.stage
+        :return: id of media file or None
         """
         # get filename form file path
         file_name = pathlib.Path(file_path).name
         self.logger.info(f"Prepare to add {file_name}")
 
-        # get names of existed media files
-        r_existed_content = self.session.get(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/content/groups/0?',
-            headers=self.headers,
-            data=self.data
-        )
-        existed_content = {content['name'] for content in r_existed_content.json()['content']}
-
-        if file_name not in existed_content:
+        with stage('content_lookup'):
+            digest = self.content_store.digest(file_path)
+        # concurrent tasks with the same creative wait for a single upload
+        with self.content_store.lock(digest):
+            with stage('content_lookup'):
+                content_id = self._stored_content_id(digest)
+                if content_id is not None and not self.content_catalog.contains(content_id, self.get_content_listing):
+                    self._forget_content(digest)
+                    content_id = None
+
+            uploaded = content_id is None
+            if uploaded:
+                with stage('upload'):
+                    content_id = self._upload_content(file_path, file_name)
+            self._content_added(digest, file_name, content_id, uploaded)
+        return content_id
+
+    def _upload_content(self, file_path: str, file_name: str) -> Optional[int]:
+        """
+        Upload media file to storage at once or by chunks depending on its size.
+        :return: id of media file or None
+        """
+        # request data for upload file
+        data_ = self._upload_data(file_path, file_name)
+        size = data_['size']
+        # the upload is told apart from older content with the same name by its id
+        before = self.content_catalog.ids(file_name, self.get_content_listing)
+        started = time.monotonic()
 
-            # get size of file in bytes
-            size = os.path.getsize(file_path)
+        if size < self.config.chunk_size:
+            self.logger.info("Uploading entire object...")
 
-            # request data for upload file
-            data_ = {
-                'name': file_name,
-                'group_id': 0,
-                'size': size,
-                'decode': True,
-            }
             with open(file_path, "rb") as f:
+                # file is represented in bytes, read up front so the request can be repeated after re-login
+                files = {
+                    'chunk': (file_name, f.read()),
+                }
+            r_upload = self._request(
+                'POST',
+                f'{self.api_url}/v5/platforms/{self.platform_id}/content/file/upload',
+                files=files,
+                data=data_
+            )
+            self._raise_for_status(r_upload, f'{file_name} has not been uploaded')
+            uploaded_bytes_counter.inc(size)
 
-                if size < 512_000:
-                    self.logger.info("Uploading entire object...")
-
-                    # file is represented in bytes
-                    files = {
-                        'chunk': f,
-                    }
-                    self.session.post(
-                        f'https://api.ar.digital/v5/platforms/{self.platform_id}/content/file/upload',
-                        headers=self.headers,
-                        files=files,
-                        data=data_
-                    )
-
-                else:
-
-                    # needed for add extra headers with content-length
-                    headers = self.headers
-
-                    file_id = None
-
-                    for chunk in utils.read_in_chunks(f, 512_000):
-                        self.logger.info("Uploading object by chunks")
-
-                        files = {
-                            'chunk': chunk,
-                        }
-                        headers['content-length'] = f'{len(chunk)}'
-
-                        r_chunk_res = self.session.post(
-                            f'https://api.ar.digital/v5/platforms/{self.platform_id}/content/file/upload',
-                            headers=headers,
-                            files=files,
-                            data=data_
-                        )
-
-                        if file_id is None:
-                            file_id = r_chunk_res.json()['file_id']
-                            data_['file_id'] = file_id,
-
-                self.logger.info(f"{file_name} has been uploaded")
         else:
-            self.logger.info(f"{file_name} already added")
+            journal = self._upload_journal(file_path)
+            try:
+                r_upload = self._upload_by_chunks(file_path, data_, journal)
+            except exceptions.AddRealityError:
+                if not journal.resumed:
+                    raise
+                # upload session could have expired on the server side, start it from scratch
+                self.logger.warning(f"Resuming upload of {file_name} has failed, uploading it again")
+                journal.reset()
+                r_upload = self._upload_by_chunks(file_path, data_, journal)
+            journal.remove()
+
+        self._upload_finished(data_, started)
+        return self._register_uploaded_content(file_name, r_upload, before)
+
+    def _upload_by_chunks(
+            self,
+            file_path: str,
+            data_: dict,
+            journal: 'UploadJournal',
+    ) -> Optional['requests.Response']:
+        """
+        Upload file by chunks skipping the ones acknowledged in journal.
+        The first chunk opens upload session and the last one completes it, so both are sent alone,
+        chunks in between are sent by up to upload_concurrency requests at once.
+        :return: response to the last chunk, None if it had been acknowledged before resuming
+        """
+        chunks, middle = self._chunks_left(data_, journal)
+
+        response = None
+        if 0 not in journal.acked:
+            response = self._upload_chunk(file_path, 0, data_)
+            self._upload_started(response, data_, journal)
+            middle = [i for i in middle if i not in journal.acked]
+        data_ = {**data_, 'file_id': journal.file_id}
+
+        if middle:
+            concurrency = max(1, min(self.config.upload_concurrency, len(middle)))
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = {executor.submit(self._upload_chunk, file_path, i, data_, concurrency > 1): i
+                           for i in middle}
+                for future in as_completed(futures):
+                    future.result()
+                    journal.ack(futures[future])
+
+        if chunks > 1 and chunks - 1 not in journal.acked:
+            response = self._upload_chunk(file_path, chunks - 1, data_)
+            journal.ack(chunks - 1)
+        return response
+
+    def _upload_chunk(self, file_path: str, index: int, data_: dict, with_offset: bool = False) -> 'requests.Response':
+        """
+        Upload one chunk of file, retrying it on failure.
+        :param index: number of chunk
+        :param with_offset: send offset of chunk, required when chunks are uploaded out of order
+        :return: requests.Response
+        """
+        with open(file_path, 'rb') as f:
+            f.seek(index * self.config.chunk_size)
+            chunk = f.read(self.config.chunk_size)
+        files = {
+            'chunk': chunk,
+        }
+        data_ = self._chunk_data(data_, index, with_offset)
+
+        error = None
+        for attempt in range(self.config.chunk_retries + 1):
+            time.sleep(self._chunk_retry_delay(attempt))
+            try:
+                response = self._request(
+                    'POST',
+                    f'{self.api_url}/v5/platforms/{self.platform_id}/content/file/upload',
+                    files=files,
+                    data=data_
+                )
+            except self.network_errors as ex:
+                error = repr(ex)
+                continue
+            error = self._chunk_uploaded(response, len(chunk))
+            if error is None:
+                return response
+        raise exceptions.AddRealityError(f'Chunk {index} of {data_["name"]} has not been uploaded: {error}')
+
+    def _register_uploaded_content(
+            self,
+            file_name: str,
+            response: 'requests.Response',
+            before: set[int],
+    ) -> Optional[int]:
+        """
+        Put id of uploaded file into the content catalog, fetch the listing again only
+        if the upload response doesn't carry it.
+        :param before: ids of content with the name before the upload
+        """
+        content_id = self._uploaded_content_id(file_name, response)
+        if content_id is not None:
+            return content_id
+        return self._new_content_id(file_name, before, self.get_content_listing())
 
     def clear_archive(self) -> None:
         """
@@ -252,53 +438,105 @@ class AddRealityHandler:
         :return: None
         """
         self.logger.info("Clearing archive...")
-        r_archived_campaigns = self.session.get(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/campaign/archive',
-            headers=self.headers,
+        r_archived_campaigns = self._request(
+            'GET',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/archive',
             data=self.data,
         )
         for campaign in r_archived_campaigns.json()['campaigns']:
-            self.session.delete(
-                f'https://api.ar.digital/v5/platforms/{self.platform_id}/campaign/{campaign["id"]}',
-                headers=self.headers,
+            self._request(
+                'DELETE',
+                f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/{campaign["id"]}',
                 data=self.data,
             )
         self.logger.info("Archive has been cleared")
 
-    def delete_campaigns(self, campaign_ids: list[int] = None) -> None:
+    def delete_campaigns(self, campaign_ids: list[int] = None, only_playing: bool = True) -> None:
         """
-        Archive and delete campaigns.
+        Archive and delete playing campaigns, up to delete_concurrency of them at once.
+        Campaigns missing from the listing are skipped.
         :param campaign_ids: list of advertising campaigns
+        :param only_playing: False deletes the campaigns whatever their status without fetching the listing
         :return: None
         """
         self.logger.info("Deleting playing campaigns...")
 
-        campaigns_for_delete = {}
+        if only_playing:
+            campaigns_for_delete = self.get_campaign_statuses()
+            if any(campaign_id not in campaigns_for_delete for campaign_id in campaign_ids):
+                campaigns_for_delete = self.get_campaign_statuses(force=True)
+            playing = self._campaigns_to_delete(campaign_ids, campaigns_for_delete)
+        else:
+            playing = list(campaign_ids)
+
+        errors = {}
+        if playing:
+            concurrency = max(1, min(self.config.delete_concurrency, len(playing)))
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = {executor.submit(self._delete_campaign, campaign_id): campaign_id
+                           for campaign_id in playing}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except (exceptions.AddRealityError, *self.network_errors) as ex:
+                        errors[futures[future]] = ex
+        self._raise_delete_errors(errors)
+        self.logger.info("All playing campaigns has been deleted")
 
-        playing_campaigns = self.session.get(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/campaign/groups/0',
-            headers=self.headers,
-            data=json.dumps(self.data)
-        ).json()['campaigns']
-
-        for campaign in playing_campaigns:
-            campaigns_for_delete[campaign['id']] = campaign['status']
-
-        data_ = self.data
-        data_['is_archived'] = True  # noqa
-        for campaign_id in campaign_ids:
-            if campaigns_for_delete[campaign_id] == 'playing':
-                self.session.put(
-                    f'https://api.ar.digital/v5/platforms/{self.platform_id}/campaign/{campaign_id}',
-                    headers=self.headers,
-                    data=json.dumps(data_)
-                )
-                self.session.delete(
-                    f'https://api.ar.digital/v5/platforms/{self.platform_id}/campaign/{campaign_id}',
-                    headers=self.headers,
-                    data=self.data
+    def _delete_campaign(self, campaign_id: int) -> None:
+        """
+        Archive campaign and delete it, a campaign already gone on the server counts as deleted.
+        :param campaign_id: id of campaign
+        :return: None
+        """
+        data_ = {**self.data, 'is_archived': True}
+        for method, data in (('PUT', json.dumps(data_)), ('DELETE', self.data)):
+            response = self._request(
+                method,
+                f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/{campaign_id}',
+                data=data
+            )
+            if self._delete_step_done(method, response):
+                break
+        self.device_state.remove_campaign(campaign_id)
+
+    def get_campaign_statuses(self, force: bool = False) -> dict[int, str]:
+        """
+        Get statuses of campaigns by their ids, from the device state if it is fresh.
+        :param force: fetch the listing even if the device state is fresh
+        :raise AddRealityError: if the listing has not been received
+        :return: dict[int, str]
+        """
+        statuses = None if force else self.device_state.get_statuses()
+        if statuses is not None:
+            return statuses
+        version = self.device_state.statuses_version
+        with self._campaigns_lock:
+            # another switch of the account could have fetched the listing while we were waiting
+            statuses = None if force else self.device_state.get_statuses()
+            if statuses is None:
+                r_campaigns = self._request(
+                    'GET',
+                    f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/groups/0',
+                    data=json.dumps(self.data)
                 )
-        self.logger.info("All playing campaigns has been deleted")
+                statuses = self._store_statuses(r_campaigns, version)
+        return statuses
+
+    def refresh_device_state(self, device_ids: Iterable[int] = ()) -> None:
+        """
+        Fetch campaign statuses and campaigns of devices in use again, so switches find them fresh.
+        Requests are sent only while the rate limits have spare capacity, the rest waits for the next refresh.
+        :param device_ids: devices with a slot booked, the devices read recently are refreshed as well
+        :return: None
+        """
+        if not self.throttle.has_spare():
+            return
+        self.get_campaign_statuses(force=True)
+        for device_id in self.device_state.refresh_targets(device_ids):
+            if not self.throttle.has_spare():
+                return
+            self.get_device_info(device_id, force=True)
 
     def get_campaigns(self) -> list[int]:
         """
@@ -306,38 +544,77 @@ class AddRealityHandler:
         :return: list[int]
         """
         self.logger.info(f"Receiving campaigns from storage...")
-        r_campaigns = self.session.get(
-            f'https://api.ar.digital/v5/platforms/{self.platform_id}/campaign/groups/0',
-            headers=self.headers,
+        r_campaigns = self._request(
+            'GET',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/groups/0',
             data=self.data
         )
         res = [campaign['id'] for campaign in r_campaigns.json()['campaigns']]
         self.logger.info(f"Received campaigns {res}")
         return res
 
-    def add_and_start_campaign(self, created_campaign: dict) -> None:
+    def create_campaign(self, created_campaign: dict, status: Optional[str] = None) -> int:
         """
-        Create campaign, put generated data in it by request and start campaign.
+        Create campaign with generated data. In compact mode it takes a single POST carrying the status,
+        in full mode the payload is PUT once more and the status is set by a separate request.
         :param created_campaign: dict of advertising campaign parameters.
-        :return: None.
+        :param status: status of new campaign, None leaves it paused
+        :return: id of campaign
         """
         self.logger.info(f"Creating campaign...")
 
-        campaign = self.session.post(
-            f'https://api.ar.digital/v6/platforms/{self.platform_id}/campaign',
-            headers=self.headers,
-            data=json.dumps(created_campaign)
-        )
+        compact = self.config.campaign_create_mode == 'compact'
+        try:
+            response = self._request(
+                'POST',
+                f'{self.api_url}/v6/platforms/{self.platform_id}/campaign',
+                data=json.dumps(self._campaign_payload(created_campaign, status))
+            )
+            campaign = self._created_campaign(response)
+        except (*self.network_errors, ValueError) as ex:
+            self.logger.warning(f"Campaign {created_campaign['name']} response is lost: {ex!r}")
+            response, campaign = None, {}
+        if 'id' not in campaign:
+            # the campaign could have been created even though its response is an error
+            campaign_id = self.find_campaign(created_campaign['name'])
+            if campaign_id is None:
+                raise exceptions.AddRealityError(
+                    f"Campaign {created_campaign['name']} has not been created: "
+                    f"status {self._status(response) if response is not None else None}")
+            campaign = {'id': campaign_id}
+        campaign_id = campaign['id']
+        self.logger.info(f"Campaign {campaign_id} has been created")
 
-        campaign_id = json.loads(campaign.content)['id']
+        if not compact:
+            r_update = self._request(
+                'PUT',
+                f'{self.api_url}/v6/platforms/{self.platform_id}/campaign/{campaign_id}',
+                data=json.dumps(created_campaign)
+            )
+            self._raise_for_status(r_update, f'Campaign {campaign_id} has not been updated')
+            self.logger.info(f"Campaign {campaign_id} has been updated")
 
-        self.logger.info(f"Campaign {campaign_id} has been created")
-        self.session.put(
+        if self._campaign_created(campaign_id, created_campaign, campaign, status):
+            self.start_campaign(campaign_id)
+        return campaign_id
 
-            f'https://api.ar.digital/v6/platforms/{self.platform_id}/campaign/{campaign_id}',
-            headers=self.headers,
-            data=json.dumps(created_campaign)
+    def find_campaign(self, name: str) -> Optional[int]:
+        """
+        Find campaign by its name, names made from idempotency keys are unique.
+        :param name: name of campaign
+        :return: id of campaign or None
+        """
+        r_campaigns = self._request(
+            'GET',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/groups/0',
+            data=json.dumps(self.data)
         )
-        self.logger.info(f"Campaign {campaign_id} has been updated")
+        return self._campaign_named(r_campaigns, name)
 
-        self.start_campaign(campaign_id)
+    def add_and_start_campaign(self, created_campaign: dict) -> int:
+        """
+        Create campaign, put generated data in it by request and start campaign.
+        :param created_campaign: dict of advertising campaign parameters.
+        :return: id of campaign
+        """
+        return self.create_campaign(created_campaign, 'playing')
@@ -1,38 +1,89 @@
 import signal
+import socket
 from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
+from typing import Optional, TYPE_CHECKING
 
+from tornado.httpserver import HTTPServer
 from tornado.web import Application, url
 from tornado.ioloop import IOLoop
 
 import app
 from app.ad_processor import AdProcessor
-from app.handlers import TurnOff, TurnOn
+from app.task_queue import MemoryTaskQueue, PartitionedTaskQueue, PostgresTaskQueue, make_task_queue
+from app.handlers import (
+    BatchTurnOff,
+    BatchTurnOn,
+    DeviceTasks,
+    InvalidatePublisher,
+    Metrics,
+    TaskReadiness,
+    TaskStatus,
+    TurnOff,
+    TurnOn,
+)
 
 from app.log_lib import get_logger
+from app.metrics import registry
+
+if TYPE_CHECKING:
+    import app.cluster as cluster
 
 logger = get_logger('API')
 context = app.context
 
 class App:
 
-    def __init__(self, port: int = 4000):
+    def __init__(
+            self,
+            port: int = 4000,
+            sockets: Optional[list[socket.socket]] = None,
+            tasks_queue: 'Optional[MemoryTaskQueue | PartitionedTaskQueue | PostgresTaskQueue]' = None,
+            invalidations: 'Optional[cluster.Invalidations]' = None,
+    ):
+        """
+        :param port: port to listen on if sockets are not given
+        :param sockets: listening sockets shared by forked HTTP processes
+        :param tasks_queue: queue to processor processes, the processor runs in this process if None
+        :param invalidations: invalidation of publishers sent to the other processes in multi-process mode
+        """
         self.alive = False
-        self.tasks_queue = Queue()
         self.executor = ThreadPoolExecutor()
+        self.ad_processor: Optional[AdProcessor] = None
+        if tasks_queue is None:
+            tasks_queue = make_task_queue(context.processor_config)
+            self.ad_processor = AdProcessor(tasks_queue)
+        else:
+            registry.gauge(
+                'ad_processor_tasks_queue_depth', 'Tasks received but not dispatched to workers yet'
+            ).set_function(tasks_queue.qsize)
+        self.tasks_queue = tasks_queue
         self.application = Application(
             self.urls,
             tasks_queue=self.tasks_queue,
-            executor=self.executor
+            executor=self.executor,
+            ad_processor=self.ad_processor,
+            invalidations=invalidations,
+            # metrics of one fork on the shared port would look like counter resets on every scrape
+            shared_port=sockets is not None and context.api_config.processes > 1,
         )
-        self.server = self.application.listen(port)
-        self.ad_processor = AdProcessor(self.tasks_queue)
+        if sockets is None:
+            self.server = self.application.listen(port)
+        else:
+            self.server = HTTPServer(self.application)
+            self.server.add_sockets(sockets)
 
     @property
     def urls(self):
         return [
             url(r"/turn_on/(\d+)", TurnOn),
             url(r"/turn_off/(\d+)", TurnOff),
+            url(r"/turn_on", BatchTurnOn),
+            url(r"/turn_off", BatchTurnOff),
+            url(r"/tasks", DeviceTasks),
+            url(r"/tasks/(\w+)", TaskStatus),
+            url(r"/tasks/(\w+)/readiness", TaskReadiness),
+            url(r"/publishers/(\d+)/invalidate", InvalidatePublisher),
+            url(r"/metrics", Metrics),
         ]
 
     def start(self):
@@ -40,14 +91,16 @@ class App:
         context.load_db_controller()
         self.alive = True
         self.add_signals()
-        self.ad_processor.start()
+        if self.ad_processor is not None:
+            self.ad_processor.start()
         IOLoop.current().start()
 
     def stop(self):
         logger.info('Stopping application...')
         IOLoop.current().stop()
         self.server.stop()
-        self.ad_processor.stop()
+        if self.ad_processor is not None:
+            self.ad_processor.stop()
         context.stop()
         logger.info('Stopped.')
 
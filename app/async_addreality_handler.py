@@ -0,0 +1,577 @@
+import asyncio
+import json
+import pathlib
+import time
+from http.cookies import SimpleCookie
+from typing import Any, Callable, ContextManager, Iterable, Optional, Union
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest, HTTPResponse
+from tornado.ioloop import IOLoop
+from urllib3 import encode_multipart_formdata
+
+from app import data_classes as dc, exceptions
+from app.addreality_base import (
+    BaseAddRealityHandler,
+    count_request_error,
+    endpoint_of,
+    no_stage,
+    reauth_counter,
+    request_buckets,
+    uploaded_bytes_counter,
+)
+from app.content_catalog import ContentCatalog
+from app.content_store import ContentStore
+from app.device_state import DeviceState
+from app.metrics import registry
+from app.upload_journal import UploadJournal
+
+
+class AsyncAddRealityHandler(BaseAddRealityHandler):
+    """
+    AddRealityHandler for the IOLoop. Requests are sent by AsyncHTTPClient, so switches of many devices
+    are in flight at once without a thread per request. Instances must be used on a single IOLoop.
+    """
+    # timeouts and closed streams are raised as HTTPClientError even with raise_error=False
+    network_errors = (HTTPClientError, OSError, asyncio.TimeoutError)
+
+    def __init__(
+            self,
+            user: 'dc.User',
+            config: Optional['dc.AddRealityConfig'] = None,
+            content_catalog: Optional['ContentCatalog'] = None,
+            content_store: Optional['ContentStore'] = None,
+            device_state: Optional['DeviceState'] = None,
+            client: Optional['AsyncHTTPClient'] = None,
+    ):
+        super().__init__(user, config, content_catalog, content_store, device_state)
+        # max_clients applies only if the shared client of the IOLoop has not been created yet
+        self.client = client or AsyncHTTPClient(max_clients=self.config.async_max_clients)
+        # AsyncHTTPClient keeps no cookies, the session cookie of AddReality is kept here
+        self.cookies = SimpleCookie()
+        self._auth_lock = asyncio.Lock()
+        # threading locks of the store would block the IOLoop, uploads of a digest wait on these instead
+        self._digest_locks: dict[str, asyncio.Lock] = {}
+        # concurrent switches of the account wait for a single campaign listing
+        self._campaigns_lock = asyncio.Lock()
+
+    async def ensure_authorized(self) -> bool:
+        """
+        Log in unless the session is still authorized.
+        :return: True if the login handshake has been performed
+        """
+        async with self._auth_lock:
+            if self.is_authorized:
+                return False
+            if self.authorized_at is not None:
+                reauth_counter.inc()
+            await self.authorization()
+            return True
+
+    async def _reauthorize(self, generation: int) -> None:
+        async with self._auth_lock:
+            # another coroutine has already logged in again after our request was sent
+            if generation != self._auth_generation:
+                return
+            self.logger.info('Session has been rejected, authorizing again')
+            reauth_counter.inc()
+            await self.authorization()
+
+    @staticmethod
+    def _encode(data: Union[dict, str, None], files: Optional[dict]) -> tuple[Optional[bytes], Optional[str]]:
+        """
+        Encode body the way requests does: files as multipart form, dict as urlencoded form, str as is.
+        :return: body and its content type
+        """
+        if files:
+            fields = {key: str(value) for key, value in (data or {}).items()}
+            fields.update(files)
+            return encode_multipart_formdata(fields)
+        if isinstance(data, dict):
+            return urlencode(data).encode(), 'application/x-www-form-urlencoded'
+        if isinstance(data, str):
+            return data.encode(), None
+        return data, None
+
+    async def _send(
+            self,
+            method: str,
+            url: str,
+            data: Union[dict, str, None] = None,
+            files: Optional[dict] = None,
+    ) -> 'HTTPResponse':
+        """
+        Send request with default headers, session cookies and timeouts within the rate limits,
+        its latency is recorded per endpoint. Responses 429 and 5xx are repeated with backoff.
+        :param method: HTTP method
+        :param url: full url of endpoint
+        :return: HTTPResponse of any status, errors without response such as timeouts are raised
+        """
+        body, content_type = self._encode(data, files)
+        headers = dict(self.headers)
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={morsel.value}' for name, morsel in self.cookies.items())
+        request = HTTPRequest(
+            url,
+            method,
+            headers=headers,
+            body=body,
+            connect_timeout=self.config.connect_timeout,
+            request_timeout=self.config.connect_timeout + self.config.read_timeout,
+            # AddReality gets bodies with GET and DELETE too
+            allow_nonstandard_methods=True,
+        )
+        endpoint = endpoint_of(url)
+        histogram = registry.histogram(
+            'addreality_request_seconds', 'Latency of requests to AddReality API',
+            buckets=request_buckets, method=method, endpoint=endpoint,
+        )
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.throttle.reserve())
+            started = time.perf_counter()
+            try:
+                response = await self.client.fetch(request, raise_error=False)
+            except self.network_errors:
+                count_request_error(method, endpoint, 'error')
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+            if response.code >= 400:
+                count_request_error(method, endpoint, str(response.code))
+            for cookie in response.headers.get_list('Set-Cookie'):
+                self.cookies.load(cookie)
+            delay = self.throttle.retry_delay(method, response.code, attempt, response.headers.get('Retry-After'))
+            if delay is None:
+                return response
+            self.logger.warning(f'{method} {endpoint}: status {response.code}, retry in {delay:.2f}s')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _request(self, method: str, url: str, **kwargs) -> 'HTTPResponse':
+        """
+        Send request within the authorized session, log in again once if the server has rejected the session.
+        :param method: HTTP method
+        :param url: full url of endpoint
+        :return: HTTPResponse
+        """
+        generation = self._auth_generation
+        response = await self._send(method, url, **kwargs)
+        if response.code == 401 and self.authorized_at is not None:
+            await self._reauthorize(generation)
+            response = await self._send(method, url, **kwargs)
+        return response
+
+    @staticmethod
+    def _status(response: 'HTTPResponse') -> int:
+        return response.code
+
+    @staticmethod
+    def _json(response: 'HTTPResponse') -> Any:
+        return json.loads(response.body)
+
+    async def authorization(self) -> None:
+        """
+        Authorize user in api.
+        :raise AddRealityError: if the login has been rejected
+        :return: None
+        """
+        self.logger.info(f"Authorizing user...")
+
+        # start authorizing session
+        r_start_auth = await self._send(
+            'POST',
+            f'{self.api_url}/v5/auth/login/multi_step/start',
+            data=self.data
+        )
+        self._check_login(r_start_auth)
+        self.data['session_id'] = self._json(r_start_auth)['session_id']
+
+        # send requests with login and password and end authorizing session
+        responses = []
+        for step in ('check_login', 'commit_pwd', 'finish'):
+            responses.append(await self._send(
+                'POST',
+                f'{self.api_url}/v5/auth/login/multi_step/{step}',
+                data=json.dumps(self.data)
+            ))
+        self.headers.update({'Referrer-Policy': 'strict-origin-when-cross-origin'})
+
+        for resp in responses:
+            self._check_login(resp)
+        self._authorized()
+
+    async def get_device_info(self, device_id: int, force: bool = False) -> list[int]:
+        """
+        Get ids of campaigns of the device, from the device state if it is fresh.
+        :param device_id: id of device
+        :param force: fetch campaigns even if the device state is fresh
+        :raise AddRealityError: if the device has not been received
+        :return: list[int]
+        """
+        campaign_ids = None if force else self.device_state.get_campaigns(device_id)
+        if campaign_ids is None:
+            version = self.device_state.device_version(device_id)
+            r_device_info = await self._request(
+                'GET',
+                f'{self.api_url}/v5/platforms/{self.platform_id}/devices/{device_id}'
+            )
+            campaign_ids = self._store_device_campaigns(device_id, r_device_info, version)
+        return campaign_ids
+
+    async def start_campaign(self, campaign_id: int) -> None:
+        """
+        Play the advertising campaign.
+        :param campaign_id: id of campaign
+        :raise AddRealityError: if the campaign has not been started
+        :return: None
+        """
+        r_start = await self._request(
+            'PUT',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/{campaign_id}',
+            data=json.dumps({'status': 'playing'})
+        )
+        self._raise_for_status(r_start, f'Campaign {campaign_id} has not been started')
+        self.logger.info(f"Campaign {campaign_id} has been started")
+        self.device_state.set_status(campaign_id, 'playing')
+
+    async def get_content_listing(self) -> list[tuple[str, int]]:
+        """
+        Get names and ids of all media files in storage.
+        :return: list[tuple[str, int]]
+        """
+        self.logger.info(f"Receiving content from storage...")
+        r_uploaded_content = await self._request(
+            'GET',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/content/groups/0?',
+            data=self.data,
+        )
+        return self._content_listing(r_uploaded_content)
+
+    async def get_content_id(self, file_path: str) -> Optional[int]:
+        """
+        Get id of media file from the content catalog of platform.
+        :param file_path: path to media file on server
+        :return: id of media file or None
+        """
+        file_name = pathlib.Path(file_path).name
+        return await self.content_catalog.alookup(file_name, self.get_content_listing)
+
+    async def add_content(self, file_path: str, stage: Callable[[str], ContextManager] = no_stage) -> Optional[int]:
+        """
+        Add media file to storage unless a file with the same contents has already been uploaded to the platform.
+        :param file_path: path to media file on server
+        :param stage: timer of the content_lookup and upload stages, TaskWrapper.stage
+        :return: id of media file or None
+        """
+        file_name = pathlib.Path(file_path).name
+        self.logger.info(f"Prepare to add {file_name}")
+
+        with stage('content_lookup'):
+            digest = await IOLoop.current().run_in_executor(None, self.content_store.digest, file_path)
+        # concurrent tasks with the same creative wait for a single upload
+        async with self._digest_locks.setdefault(digest, asyncio.Lock()):
+            with stage('content_lookup'):
+                content_id = self._stored_content_id(digest)
+                if content_id is not None \
+                        and not await self.content_catalog.acontains(content_id, self.get_content_listing):
+                    self._forget_content(digest)
+                    content_id = None
+
+            uploaded = content_id is None
+            if uploaded:
+                with stage('upload'):
+                    content_id = await self._upload_content(file_path, file_name)
+            self._content_added(digest, file_name, content_id, uploaded)
+        return content_id
+
+    async def _upload_content(self, file_path: str, file_name: str) -> Optional[int]:
+        """
+        Upload media file to storage at once or by chunks depending on its size.
+        :return: id of media file or None
+        """
+        data_ = self._upload_data(file_path, file_name)
+        size = data_['size']
+        # the upload is told apart from older content with the same name by its id
+        before = await self.content_catalog.aids(file_name, self.get_content_listing)
+        started = time.monotonic()
+
+        if size < self.config.chunk_size:
+            self.logger.info("Uploading entire object...")
+            chunk = await self._read_chunk(file_path, 0)
+            r_upload = await self._request(
+                'POST',
+                f'{self.api_url}/v5/platforms/{self.platform_id}/content/file/upload',
+                files={'chunk': (file_name, chunk)},
+                data=data_
+            )
+            self._raise_for_status(r_upload, f'{file_name} has not been uploaded')
+            uploaded_bytes_counter.inc(size)
+
+        else:
+            journal = self._upload_journal(file_path)
+            try:
+                r_upload = await self._upload_by_chunks(file_path, data_, journal)
+            except exceptions.AddRealityError:
+                if not journal.resumed:
+                    raise
+                # upload session could have expired on the server side, start it from scratch
+                self.logger.warning(f"Resuming upload of {file_name} has failed, uploading it again")
+                journal.reset()
+                r_upload = await self._upload_by_chunks(file_path, data_, journal)
+            journal.remove()
+
+        self._upload_finished(data_, started)
+        return await self._register_uploaded_content(file_name, r_upload, before)
+
+    async def _read_chunk(self, file_path: str, index: int) -> bytes:
+        def read() -> bytes:
+            with open(file_path, 'rb') as f:
+                f.seek(index * self.config.chunk_size)
+                return f.read(self.config.chunk_size)
+
+        return await IOLoop.current().run_in_executor(None, read)
+
+    async def _upload_by_chunks(
+            self,
+            file_path: str,
+            data_: dict,
+            journal: 'UploadJournal',
+    ) -> Optional['HTTPResponse']:
+        """
+        Upload file by chunks skipping the ones acknowledged in journal.
+        The first chunk opens upload session and the last one completes it, so both are sent alone,
+        chunks in between are sent by up to upload_concurrency requests at once.
+        :return: response to the last chunk, None if it had been acknowledged before resuming
+        """
+        chunks, middle = self._chunks_left(data_, journal)
+
+        response = None
+        if 0 not in journal.acked:
+            response = await self._upload_chunk(file_path, 0, data_)
+            self._upload_started(response, data_, journal)
+            middle = [i for i in middle if i not in journal.acked]
+        data_ = {**data_, 'file_id': journal.file_id}
+
+        if middle:
+            concurrency = max(1, min(self.config.upload_concurrency, len(middle)))
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def upload(index: int) -> None:
+                async with semaphore:
+                    await self._upload_chunk(file_path, index, data_, concurrency > 1)
+                journal.ack(index)
+
+            await asyncio.gather(*(upload(i) for i in middle))
+
+        if chunks > 1 and chunks - 1 not in journal.acked:
+            response = await self._upload_chunk(file_path, chunks - 1, data_)
+            journal.ack(chunks - 1)
+        return response
+
+    async def _upload_chunk(
+            self,
+            file_path: str,
+            index: int,
+            data_: dict,
+            with_offset: bool = False,
+    ) -> 'HTTPResponse':
+        """
+        Upload one chunk of file, retrying it on failure.
+        :param index: number of chunk
+        :param with_offset: send offset of chunk, required when chunks are uploaded out of order
+        :return: HTTPResponse
+        """
+        chunk = await self._read_chunk(file_path, index)
+        data_ = self._chunk_data(data_, index, with_offset)
+
+        error = None
+        for attempt in range(self.config.chunk_retries + 1):
+            await asyncio.sleep(self._chunk_retry_delay(attempt))
+            try:
+                response = await self._request(
+                    'POST',
+                    f'{self.api_url}/v5/platforms/{self.platform_id}/content/file/upload',
+                    files={'chunk': ('chunk', chunk)},
+                    data=data_
+                )
+            except self.network_errors as ex:
+                error = repr(ex)
+                continue
+            error = self._chunk_uploaded(response, len(chunk))
+            if error is None:
+                return response
+        raise exceptions.AddRealityError(f'Chunk {index} of {data_["name"]} has not been uploaded: {error}')
+
+    async def _register_uploaded_content(
+            self,
+            file_name: str,
+            response: 'HTTPResponse',
+            before: set[int],
+    ) -> Optional[int]:
+        """
+        Put id of uploaded file into the content catalog, fetch the listing again only
+        if the upload response doesn't carry it.
+        :param before: ids of content with the name before the upload
+        """
+        content_id = self._uploaded_content_id(file_name, response)
+        if content_id is not None:
+            return content_id
+        return self._new_content_id(file_name, before, await self.get_content_listing())
+
+    async def delete_campaigns(self, campaign_ids: list[int] = None, only_playing: bool = True) -> None:
+        """
+        Archive and delete playing campaigns, up to delete_concurrency of them at once.
+        Campaigns missing from the listing are skipped.
+        :param campaign_ids: list of advertising campaigns
+        :param only_playing: False deletes the campaigns whatever their status without fetching the listing
+        :return: None
+        """
+        self.logger.info("Deleting playing campaigns...")
+
+        if only_playing:
+            campaigns_for_delete = await self.get_campaign_statuses()
+            if any(campaign_id not in campaigns_for_delete for campaign_id in campaign_ids):
+                campaigns_for_delete = await self.get_campaign_statuses(force=True)
+            playing = self._campaigns_to_delete(campaign_ids, campaigns_for_delete)
+        else:
+            playing = list(campaign_ids)
+
+        semaphore = asyncio.Semaphore(max(1, self.config.delete_concurrency))
+
+        async def delete(campaign_id: int) -> None:
+            async with semaphore:
+                await self._delete_campaign(campaign_id)
+
+        results = await asyncio.gather(*(delete(campaign_id) for campaign_id in playing), return_exceptions=True)
+        errors = {}
+        for campaign_id, result in zip(playing, results):
+            if isinstance(result, (exceptions.AddRealityError, *self.network_errors)):
+                errors[campaign_id] = result
+            elif isinstance(result, BaseException):
+                raise result
+        self._raise_delete_errors(errors)
+        self.logger.info("All playing campaigns has been deleted")
+
+    async def _delete_campaign(self, campaign_id: int) -> None:
+        """
+        Archive campaign and delete it, a campaign already gone on the server counts as deleted.
+        :param campaign_id: id of campaign
+        :return: None
+        """
+        data_ = {**self.data, 'is_archived': True}
+        for method, data in (('PUT', json.dumps(data_)), ('DELETE', self.data)):
+            response = await self._request(
+                method,
+                f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/{campaign_id}',
+                data=data
+            )
+            if self._delete_step_done(method, response):
+                break
+        self.device_state.remove_campaign(campaign_id)
+
+    async def get_campaign_statuses(self, force: bool = False) -> dict[int, str]:
+        """
+        Get statuses of campaigns by their ids, from the device state if it is fresh.
+        :param force: fetch the listing even if the device state is fresh
+        :raise AddRealityError: if the listing has not been received
+        :return: dict[int, str]
+        """
+        statuses = None if force else self.device_state.get_statuses()
+        if statuses is not None:
+            return statuses
+        version = self.device_state.statuses_version
+        async with self._campaigns_lock:
+            # another switch of the account could have fetched the listing while we were waiting
+            statuses = None if force else self.device_state.get_statuses()
+            if statuses is None:
+                r_campaigns = await self._request(
+                    'GET',
+                    f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/groups/0',
+                    data=json.dumps(self.data)
+                )
+                statuses = self._store_statuses(r_campaigns, version)
+        return statuses
+
+    async def refresh_device_state(self, device_ids: Iterable[int] = ()) -> None:
+        """
+        Fetch campaign statuses and campaigns of devices in use again, so switches find them fresh.
+        Requests are sent only while the rate limits have spare capacity, the rest waits for the next refresh.
+        :param device_ids: devices with a slot booked, the devices read recently are refreshed as well
+        :return: None
+        """
+        if not self.throttle.has_spare():
+            return
+        await self.get_campaign_statuses(force=True)
+        for device_id in self.device_state.refresh_targets(device_ids):
+            if not self.throttle.has_spare():
+                return
+            await self.get_device_info(device_id, force=True)
+
+    async def create_campaign(self, created_campaign: dict, status: Optional[str] = None) -> int:
+        """
+        Create campaign with generated data. In compact mode it takes a single POST carrying the status,
+        in full mode the payload is PUT once more and the status is set by a separate request.
+        :param created_campaign: dict of advertising campaign parameters.
+        :param status: status of new campaign, None leaves it paused
+        :return: id of campaign
+        """
+        self.logger.info(f"Creating campaign...")
+
+        compact = self.config.campaign_create_mode == 'compact'
+        try:
+            response = await self._request(
+                'POST',
+                f'{self.api_url}/v6/platforms/{self.platform_id}/campaign',
+                data=json.dumps(self._campaign_payload(created_campaign, status))
+            )
+            campaign = self._created_campaign(response)
+        except (*self.network_errors, ValueError) as ex:
+            self.logger.warning(f"Campaign {created_campaign['name']} response is lost: {ex!r}")
+            response, campaign = None, {}
+        if 'id' not in campaign:
+            # the campaign could have been created even though its response is an error
+            campaign_id = await self.find_campaign(created_campaign['name'])
+            if campaign_id is None:
+                raise exceptions.AddRealityError(
+                    f"Campaign {created_campaign['name']} has not been created: "
+                    f"status {response.code if response is not None else None}")
+            campaign = {'id': campaign_id}
+        campaign_id = campaign['id']
+        self.logger.info(f"Campaign {campaign_id} has been created")
+
+        if not compact:
+            r_update = await self._request(
+                'PUT',
+                f'{self.api_url}/v6/platforms/{self.platform_id}/campaign/{campaign_id}',
+                data=json.dumps(created_campaign)
+            )
+            self._raise_for_status(r_update, f'Campaign {campaign_id} has not been updated')
+            self.logger.info(f"Campaign {campaign_id} has been updated")
+
+        if self._campaign_created(campaign_id, created_campaign, campaign, status):
+            await self.start_campaign(campaign_id)
+        return campaign_id
+
+    async def find_campaign(self, name: str) -> Optional[int]:
+        """
+        Find campaign by its name, names made from idempotency keys are unique.
+        :param name: name of campaign
+        :return: id of campaign or None
+        """
+        r_campaigns = await self._request(
+            'GET',
+            f'{self.api_url}/v5/platforms/{self.platform_id}/campaign/groups/0',
+            data=json.dumps(self.data)
+        )
+        return self._campaign_named(r_campaigns, name)
+
+    async def add_and_start_campaign(self, created_campaign: dict) -> int:
+        """
+        Create campaign, put generated data in it by request and start campaign.
+        :param created_campaign: dict of advertising campaign parameters.
+        :return: id of campaign
+        """
+        return await self.create_campaign(created_campaign, 'playing')
@@ -43,9 +43,13 @@ def create_content(content_id):
     return content
 
 
-def create_campaign(content_id: int, campaign: 'dc.AdTaskConfig'):
+def create_campaign(content_id: int, campaign: 'dc.AdTaskConfig', key: Optional[str] = None):
+    """
+    :param key: idempotency key of the campaign, such as id of task, it makes the name unique and stable
+    across retries, so a campaign created by a failed attempt is found by its name
+    """
     return {
-        'gender': 3, 'name': f'{campaign.name}-{utils.file_id_generator()}', 'playlist': [],
+        'gender': 3, 'name': f'{campaign.name}-{key or utils.file_id_generator()}', 'playlist': [],
         'content': create_content(content_id),
         'project_id': 14993,
         'devices_delta': {
@@ -0,0 +1,125 @@
+import multiprocessing
+import signal
+import threading
+
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+
+import app
+import app.data_classes as dc
+from app import metrics
+from app.ad_processor import AdProcessor
+from app.application import App
+from app.hash_ring import HashRing
+from app.log_lib import get_logger
+from app.task_queue import PartitionedTaskQueue, PostgresTaskQueue, ProcessTaskQueue
+from app.ttl_cache import TTLCache
+
+logger = get_logger('Cluster')
+context = app.context
+
+
+class Invalidations:
+    """
+    Invalidation of cached publishers sent to every process of the cluster, each process has its own inbox
+    created before forking and read by a daemon thread.
+    """
+
+    def __init__(self, processes: int):
+        self.inboxes: list['multiprocessing.Queue[int]'] = [multiprocessing.Queue() for _ in range(processes)]
+        self.index: int = -1
+
+    def start(self, index: int, cache: 'TTLCache[dc.User]') -> None:
+        """
+        :param index: task_id of this process
+        :param cache: publishers cache of this process
+        """
+        self.index = index
+        inbox = self.inboxes[index]
+
+        def receive():
+            while True:
+                cache.invalidate(inbox.get())
+
+        threading.Thread(target=receive, name='invalidations', daemon=True).start()
+
+    def publish(self, device_id: int) -> None:
+        """Invalidate the publisher of device in the other processes."""
+        for index, inbox in enumerate(self.inboxes):
+            if index != self.index:
+                inbox.put(device_id)
+
+
+class Cluster:
+    """
+    Multi-process mode: api.processes HTTP processes accept requests on one port
+    and processor.processes processes run AdProcessor. Every device is owned by one processor process
+    chosen by consistent hashing of device_id, so tasks of a device keep their order.
+    Tasks go to the owner through a pipe with the memory queue or through the partition column of the tasks table
+    with the postgres queue. Forked processes are restarted by tornado if they die.
+    Every processor process keeps its own content store and upload journals, and invalidation of
+    a publisher is sent to all processes.
+    """
+
+    def __init__(self, port: int = 4000):
+        self.port = port
+        self.api_processes = context.api_config.processes
+        self.processor_config = context.processor_config
+        self.ring: HashRing[int] = HashRing(range(self.processor_config.processes))
+
+    def start(self):
+        sockets = bind_sockets(self.port)
+        durable = self.processor_config.queue == 'postgres'
+        queues = [] if durable else [multiprocessing.Queue() for _ in range(self.processor_config.processes)]
+        invalidations = Invalidations(self.api_processes + self.processor_config.processes)
+        logger.info(
+            f'Starting {self.api_processes} HTTP and {self.processor_config.processes} processor processes...')
+        # the parent only waits for the children from here on
+        task_id = fork_processes(self.api_processes + self.processor_config.processes)
+        invalidations.start(task_id, context.publishers_cache)
+        if task_id < self.api_processes:
+            if context.api_config.metrics_port and self.api_processes > 1:
+                # the shared port is answered by any fork, so every fork is scraped on its own port
+                metrics.serve(context.api_config.metrics_port + task_id)
+            if durable:
+                tasks_queue = PostgresTaskQueue(self.processor_config, ring=self.ring)
+            else:
+                tasks_queue = PartitionedTaskQueue(queues, self.ring)
+            App(sockets=sockets, tasks_queue=tasks_queue, invalidations=invalidations).start()
+        else:
+            for sock in sockets:
+                sock.close()
+            partition = task_id - self.api_processes
+            if durable:
+                self.run_processor(partition, PostgresTaskQueue(self.processor_config, partition=partition))
+            else:
+                self.run_processor(
+                    partition, ProcessTaskQueue(queues[partition], self.processor_config.dead_letters_size))
+
+    @staticmethod
+    def run_processor(partition: int, tasks_queue: 'ProcessTaskQueue | PostgresTaskQueue') -> None:
+        """
+        Run AdProcessor of one partition till SIGTERM or SIGINT.
+        """
+        logger.info(f'Starting processor of partition {partition}...')
+        # devices of an account are spread over all processor processes, so they split its rate limits
+        config = context.add_reality_config
+        config.rate_limit /= context.processor_config.processes
+        config.global_rate_limit /= context.processor_config.processes
+        if tasks_queue.durable:
+            context.load_db_controller()
+        ad_processor = AdProcessor(tasks_queue)
+        metrics_server = None
+        if context.processor_config.metrics_port:
+            # processor processes have no API, their metrics are scraped separately
+            metrics_server = metrics.serve(context.processor_config.metrics_port + partition)
+        stopped = threading.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda signum, stack: stopped.set())
+        ad_processor.start()
+        stopped.wait()
+        ad_processor.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        context.stop()
+        logger.info(f'Processor of partition {partition} stopped.')
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from typing import Awaitable, Callable, Optional
+
+from app.metrics import registry
+
+catalog_refresh_counter = registry.counter(
+    'addreality_content_catalog_refresh_total', 'Full content listings fetched from AddReality')
+catalog_lookup_counter = registry.counter(
+    'addreality_content_catalog_lookup_total', 'Content lookups by name')
+
+
+class ContentCatalog:
+    """
+    Index name → content_id of the content storage of one platform.
+    The full listing is fetched again only when the index is older than ttl seconds,
+    uploads made by the service are added to it right away.
+    """
+
+    def __init__(self, platform_id: int, ttl: int):
+        self.platform_id = platform_id
+        self.ttl = ttl
+        self.loaded_at: Optional[float] = None
+        self._index: dict[str, int] = {}
+        self._ids: set[int] = set()
+        # every content_id of a name, names are not unique in the storage
+        self._names: dict[str, set[int]] = {}
+        self._refresh_lock = threading.Lock()
+        self._async_refresh_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def is_fresh(self) -> bool:
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    def lookup(self, name: str, load: Callable[[], list[tuple[str, int]]]) -> Optional[int]:
+        """
+        Get content_id by file name.
+        :param name: name of file in the storage
+        :param load: callable which fetches the full listing, it is called only if the index is stale
+        :return: content_id or None
+        """
+        catalog_lookup_counter.inc()
+        self._ensure_fresh(load)
+        return self._index.get(name)
+
+    def contains(self, content_id: int, load: Callable[[], list[tuple[str, int]]]) -> bool:
+        """
+        Check that content still exists in the storage.
+        :param content_id: id of content
+        :param load: callable which fetches the full listing, it is called only if the index is stale
+        :return: bool
+        """
+        catalog_lookup_counter.inc()
+        self._ensure_fresh(load)
+        return content_id in self._ids
+
+    def ids(self, name: str, load: Callable[[], list[tuple[str, int]]]) -> set[int]:
+        """
+        Get ids of all content with the name.
+        :param name: name of file in the storage
+        :param load: callable which fetches the full listing, it is called only if the index is stale
+        :return: set of content_id
+        """
+        self._ensure_fresh(load)
+        return set(self._names.get(name, ()))
+
+    def _ensure_fresh(self, load: Callable[[], list[tuple[str, int]]]) -> None:
+        if not self.is_fresh:
+            with self._refresh_lock:
+                # other worker could have refreshed the index while we were waiting
+                if not self.is_fresh:
+                    self.replace(load())
+
+    async def alookup(self, name: str, load: Callable[[], Awaitable[list[tuple[str, int]]]]) -> Optional[int]:
+        """
+        Same as lookup for the IOLoop.
+        :param name: name of file in the storage
+        :param load: coroutine function which fetches the full listing
+        :return: content_id or None
+        """
+        catalog_lookup_counter.inc()
+        await self._ensure_fresh_async(load)
+        return self._index.get(name)
+
+    async def acontains(self, content_id: int, load: Callable[[], Awaitable[list[tuple[str, int]]]]) -> bool:
+        """
+        Same as contains for the IOLoop.
+        :param content_id: id of content
+        :param load: coroutine function which fetches the full listing
+        :return: bool
+        """
+        catalog_lookup_counter.inc()
+        await self._ensure_fresh_async(load)
+        return content_id in self._ids
+
+    async def aids(self, name: str, load: Callable[[], Awaitable[list[tuple[str, int]]]]) -> set[int]:
+        """
+        Same as ids for the IOLoop.
+        :param name: name of file in the storage
+        :param load: coroutine function which fetches the full listing
+        :return: set of content_id
+        """
+        await self._ensure_fresh_async(load)
+        return set(self._names.get(name, ()))
+
+    async def _ensure_fresh_async(self, load: Callable[[], Awaitable[list[tuple[str, int]]]]) -> None:
+        if not self.is_fresh:
+            if self._async_refresh_lock is None:
+                self._async_refresh_lock = asyncio.Lock()
+            async with self._async_refresh_lock:
+                if not self.is_fresh:
+                    self.replace(await load())
+
+    def replace(self, listing: list[tuple[str, int]]) -> None:
+        """
+        :param listing: pairs of name and content_id, names are not unique in the storage
+        """
+        catalog_refresh_counter.inc()
+        self._index = dict(listing)
+        self._ids = {content_id for _, content_id in listing}
+        self._names = {}
+        for name, content_id in listing:
+            self._names.setdefault(name, set()).add(content_id)
+        self.loaded_at = time.monotonic()
+
+    def add(self, name: str, content_id: int) -> None:
+        self._index[name] = content_id
+        self._ids.add(content_id)
+        self._names.setdefault(name, set()).add(content_id)
+
+    def invalidate(self) -> None:
+        self.loaded_at = None
@@ -0,0 +1,145 @@
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import threading
+from typing import ContextManager, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # no file locks on Windows, the store is shared by threads of one process only
+    fcntl = None
+
+
+def file_digest(file_path: str) -> str:
+    """
+    SHA-256 of file contents, the file is mapped into memory instead of being read at once.
+    :param file_path: path to file
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def file_lock(path: Optional[str]) -> Iterator[None]:
+    """
+    Exclusive lock of the file among processes, every holder opens the file on its own,
+    so threads of one process exclude each other as well.
+    :param path: lock file, None or a platform without file locks takes no lock
+    """
+    if path is None or fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ContentStore:
+    """
+    Content-addressed index of uploaded media: digest of file → content_id on every platform.
+    Identical files share one upload on a platform whatever their names are.
+    The index file is shared by all processes: writes are merged into its latest version under a file lock
+    and reads pick up the entries written by the other processes.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: JSON file the index is persisted to, None keeps it in memory only
+        """
+        self.path = path
+        # digests are cached by path, size and modification time of file to avoid hashing it again
+        self._files: dict[str, tuple[int, int, str]] = {}
+        self._content: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._digest_locks: dict[str, threading.Lock] = {}
+        # inode and modification time of the index file as last loaded
+        self._version: Optional[tuple[int, int]] = None
+
+        if path is not None:
+            self._load()
+
+    def _file_version(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _load(self) -> None:
+        """Read the index written by any process, called under _lock or before the store is shared."""
+        if self.path is None:
+            return
+        version = self._file_version()
+        if version is None or version == self._version:
+            return
+        with contextlib.suppress(FileNotFoundError, ValueError, KeyError):
+            with open(self.path) as f:
+                state = json.load(f)
+            self._files = {**{k: tuple(v) for k, v in state['files'].items()}, **self._files}
+            self._content = state['content']
+        self._version = version
+
+    def digest(self, file_path: str) -> str:
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        cached = self._files.get(file_path)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        digest = file_digest(file_path)
+        with self._lock:
+            self._files[file_path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    @contextlib.contextmanager
+    def lock(self, digest: str) -> Iterator[None]:
+        """Lock held while file with the digest is being looked up and uploaded, by any thread of any process."""
+        with self._lock:
+            digest_lock = self._digest_locks.setdefault(digest, threading.Lock())
+        with digest_lock:
+            lock_path = None
+            if self.path is not None:
+                lock_dir = f'{self.path}.locks'
+                os.makedirs(lock_dir, exist_ok=True)
+                lock_path = os.path.join(lock_dir, digest)
+            with file_lock(lock_path):
+                yield
+
+    def get(self, digest: str, platform_id: int) -> Optional[int]:
+        if self.path is not None:
+            with self._lock:
+                self._load()
+        return self._content.get(digest, {}).get(str(platform_id))
+
+    def put(self, digest: str, platform_id: int, content_id: int) -> None:
+        with self._lock, self._file_lock():
+            self._load()
+            self._content.setdefault(digest, {})[str(platform_id)] = content_id
+            self._save()
+
+    def forget(self, digest: str, platform_id: int) -> None:
+        with self._lock, self._file_lock():
+            self._load()
+            self._content.get(digest, {}).pop(str(platform_id), None)
+            self._save()
+
+    def _file_lock(self) -> ContextManager:
+        return file_lock(f'{self.path}.lock' if self.path is not None else None)
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': self._files, 'content': self._content}, f)
+        os.replace(tmp_path, self.path)
+        self._version = self._file_version()
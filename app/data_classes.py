@@ -1,6 +1,13 @@
+import contextlib
 import datetime
+import time
+import uuid
 from dataclasses import dataclass, field
-from typing import Optional
+from enum import Enum
+from typing import Iterator, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.scheduler import ScheduledJob
 
 
 @dataclass
@@ -31,10 +38,141 @@ class User:
     platform_id: int
 
 
+class Readiness(str, Enum):
+    """State of content of turn-on task."""
+    PENDING = 'pending'
+    PREPARING = 'preparing'
+    READY = 'ready'
+    FAILED = 'failed'
+    # replaced by a newer task for the same device and from_time before it has started
+    SUPERSEDED = 'superseded'
+    # a step has failed after all its retries, the task is in the dead-letter store
+    DEAD = 'dead'
+
+
+def isoformat(value: Optional[datetime.datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+@dataclass
+class StageTiming:
+    """Time spent by a task in one stage, summed over the attempts."""
+    started_at: datetime.datetime
+    finished_at: Optional[datetime.datetime] = None
+    seconds: float = 0.
+
+    def report(self) -> dict:
+        return {
+            'started_at': isoformat(self.started_at),
+            'finished_at': isoformat(self.finished_at),
+            'seconds': round(self.seconds, 6),
+        }
+
+
 @dataclass
 class TaskWrapper:
     task: Optional['AdTaskConfig']
     switch_to: bool
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    # seconds between from_time and the moment the campaign has been started
+    start_skew: Optional[float] = None
+    readiness: 'Readiness' = Readiness.PENDING
+    # campaign of the task, in atomic swap mode created ahead of from_time
+    campaign_id: Optional[int] = None
+    # seconds between the old campaigns stopping and the new one playing, negative if they overlapped
+    swap_gap: Optional[float] = None
+    # id of the newer task which has replaced this one
+    superseded_by: Optional[str] = None
+    # failed attempts by step
+    attempts: dict[str, int] = field(default_factory=dict)
+    # times the task has been handed to a processor, above 1 it could have been partly done before a restart
+    deliveries: int = 1
+    # last error of the task
+    error: Optional[str] = None
+    # pending, scheduled, started, done, failed, superseded, expired or dead
+    status: str = 'pending'
+    created_at: datetime.datetime = field(default_factory=datetime.datetime.utcnow)
+    # the moment the campaign has been started
+    started_at: Optional[datetime.datetime] = None
+    completed_at: Optional[datetime.datetime] = None
+    # auth, content_lookup, upload, delete, create, start
+    stages: dict[str, 'StageTiming'] = field(default_factory=dict)
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Add the time of the block to the stage, the block is counted even if it raises.
+        :param name: name of stage
+        """
+        timing = self.stages.get(name)
+        if timing is None:
+            timing = self.stages[name] = StageTiming(datetime.datetime.utcnow())
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            timing.seconds += time.perf_counter() - started
+            timing.finished_at = datetime.datetime.utcnow()
+
+    def stages_report(self) -> dict[str, dict]:
+        return {name: timing.report() for name, timing in self.stages.items()}
+
+    def report(self) -> dict:
+        """
+        :return: state of the task serializable to JSON
+        """
+        task = self.task
+        return {
+            'task_id': self.id,
+            'device_id': task.device_id,
+            'name': task.name,
+            'switch_to': self.switch_to,
+            'from_time': isoformat(task.from_time),
+            'to_time': isoformat(task.to_time),
+            'status': self.status,
+            'readiness': self.readiness.value,
+            'created_at': isoformat(self.created_at),
+            'started_at': isoformat(self.started_at),
+            'completed_at': isoformat(self.completed_at),
+            'start_skew': self.start_skew,
+            'swap_gap': self.swap_gap,
+            'campaign_id': self.campaign_id,
+            'superseded_by': self.superseded_by,
+            'deliveries': self.deliveries,
+            'attempts': self.attempts,
+            'error': self.error,
+            'stages': self.stages_report(),
+        }
+
+
+@dataclass
+class Booking:
+    """Slot of a device occupied by an accepted turn-on task."""
+    task_wrapper: 'TaskWrapper'
+    from_time: datetime.datetime
+    to_time: Optional[datetime.datetime]
+    turn_off_job: Optional['ScheduledJob'] = None
+    # turn-on tasks continuing the same content, ended together with the slot
+    merged: list['TaskWrapper'] = field(default_factory=list)
+    # tasks of the slot this one has taken over, completed once this one has started
+    taken_over: list['TaskWrapper'] = field(default_factory=list)
+
+
+@dataclass
+class RetryPolicy:
+    """Retries of one step of the task pipeline."""
+    retries: int = 3
+    # seconds before the first retry, multiplied by backoff for every next one up to max_delay
+    delay: float = 1.
+    backoff: float = 2.
+    max_delay: float = 60.
+
+    def delay_of(self, attempt: int) -> float:
+        """
+        :param attempt: number of failed attempts starting from 1
+        :return: seconds before the next attempt
+        """
+        return min(self.max_delay, self.delay * self.backoff ** (attempt - 1))
 
 
 @dataclass
@@ -46,6 +184,11 @@ class DBConfig:
     password: str
     pool_size: int = field(default=25)
     max_overflow: int = field(default=100)
+    # seconds to wait for a free connection before failing
+    pool_timeout: float = field(default=30.)
+    # seconds after which a connection is replaced, -1 keeps connections forever
+    pool_recycle: int = field(default=1800)
+    pool_pre_ping: bool = field(default=True)
 
     @property
     def db_con_string(self) -> str:
@@ -57,3 +200,108 @@ class DBConfig:
         return f'postgresql+asyncpg://{self.login}:{self.password}' \
                f'@{self.server}:{self.port}/{self.name}'
 
+
+@dataclass
+class AddRealityConfig:
+    api_url: str = field(default='https://api.ar.digital')
+    session_ttl: int = field(default=1800)
+    # seconds the name → content_id index of platform is trusted without fetching the listing again
+    content_ttl: int = field(default=300)
+    chunk_size: int = field(default=512_000)
+    # chunks between the first and the last one uploaded at once, more than 1 sends chunk offsets
+    upload_concurrency: int = field(default=1)
+    chunk_retries: int = field(default=3)
+    chunk_retry_delay: float = field(default=1.)
+    # directory with journals of interrupted uploads, relative to the project directory
+    upload_journal_path: str = field(default='upload_journal')
+    # digest → content_id index of uploaded media, relative to the project directory
+    content_store_path: str = field(default='content_store.json')
+    # seconds campaigns of devices and their statuses are trusted without fetching them again
+    device_state_max_age: float = field(default=30.)
+    # seconds between background refreshes of device state, 0 turns them off
+    device_state_refresh_interval: float = field(default=10.)
+    # seconds a device not read by switches is kept in device state and refreshed
+    device_state_idle: float = field(default=60.)
+    # campaigns of a device archived and deleted at once
+    delete_concurrency: int = field(default=4)
+    # compact: campaign is created by one POST with its status, full: POST, PUT of the same payload and status PUT
+    campaign_create_mode: str = field(default='compact')
+    # hosts kept in the shared connection pool and connections kept open per host
+    http_pool_connections: int = field(default=4)
+    http_pool_maxsize: int = field(default=32)
+    # seconds of idle connection before TCP keep-alive probes are sent
+    http_keepalive_idle: int = field(default=60)
+    connect_timeout: float = field(default=5.)
+    # seconds to wait for the server to send response bytes
+    read_timeout: float = field(default=30.)
+    # requests in flight of the async client, the rest wait in its queue
+    async_max_clients: int = field(default=500)
+    # requests per second and burst of one account, 0 turns the limit off
+    rate_limit: float = field(default=20.)
+    rate_burst: int = field(default=40)
+    # requests per second and burst of all accounts together
+    global_rate_limit: float = field(default=100.)
+    global_rate_burst: int = field(default=200)
+    # the rate of an account limited by AddReality is not lowered below this
+    min_rate_limit: float = field(default=1.)
+    # repeats of requests answered with 429 or 5xx, backoff doubles from retry_backoff up to retry_backoff_max
+    request_retries: int = field(default=4)
+    retry_backoff: float = field(default=.5)
+    retry_backoff_max: float = field(default=30.)
+
+
+@dataclass
+class APIConfig:
+    # credentials of publishers kept in memory by device_id
+    publisher_cache_size: int = field(default=10000)
+    publisher_cache_ttl: int = field(default=300)
+    # HTTP processes forked on the same port, more than one starts multi-process mode
+    processes: int = field(default=1)
+    # with several HTTP processes every one serves /metrics on metrics_port + its index, 0 turns it off
+    metrics_port: int = field(default=0)
+
+
+@dataclass
+class ProcessorConfig:
+    # processor processes in multi-process mode, every one owns the devices hashed to it
+    processes: int = field(default=1)
+    workers: int = field(default=8)
+    # seconds before from_time to begin the campaign swap
+    switch_lead: float = field(default=1.)
+    # create the new campaign paused ahead of from_time, start it and only then remove the old ones
+    atomic_swap: bool = field(default=True)
+    # seconds before from_time to create the campaign in atomic swap mode
+    swap_lead: float = field(default=10.)
+    # bookings of the same device closer than this number of seconds are treated as adjacent
+    merge_gap: float = field(default=1.)
+    # content uploads of accepted tasks running at once
+    prefetch_concurrency: int = field(default=4)
+    # number of recent tasks whose status can be queried
+    tasks_history: int = field(default=10000)
+    # memory keeps accepted tasks in the process, postgres stores them in the tasks table to survive restarts
+    queue: str = field(default='memory')
+    # name of the processor in claims of postgres queue, host name if empty
+    worker_id: Optional[str] = field(default=None)
+    # tasks claimed from postgres queue at once
+    queue_batch_size: int = field(default=100)
+    # seconds between claims of postgres queue while it is empty
+    queue_poll_interval: float = field(default=1.)
+    # seconds after which a claim without heartbeat is taken over by another processor
+    queue_lease: float = field(default=60.)
+    # tasks handed to processors more times are dead-lettered, they have likely crashed them
+    queue_max_deliveries: int = field(default=5)
+    # retry policy by step: content, delete, create, swap, turn_off
+    retry_policies: dict[str, 'RetryPolicy'] = field(default_factory=dict)
+    # dead-lettered tasks kept by the memory queue
+    dead_letters_size: int = field(default=1000)
+    # processor processes of multi-process mode serve /metrics on metrics_port + partition, 0 turns it off
+    metrics_port: int = field(default=0)
+
+    def __post_init__(self):
+        self.retry_policies = {
+            step: policy if isinstance(policy, RetryPolicy) else RetryPolicy(**(policy or {}))
+            for step, policy in self.retry_policies.items()
+        }
+
+    def retry_policy(self, step: str) -> 'RetryPolicy':
+        return self.retry_policies.get(step) or RetryPolicy()
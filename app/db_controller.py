@@ -1,4 +1,5 @@
 import logging
+import time
 from time import sleep
 from typing import Optional, Union
 
@@ -7,9 +8,33 @@ import sqlalchemy.engine as engine
 import sqlalchemy.ext.asyncio as asa
 from sqlalchemy.engine import Result
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 import app.exceptions as exceptions
 from app.log_lib import get_logger
+from app.metrics import registry
+
+pool_wait_histogram = registry.histogram(
+    'db_pool_wait_seconds', 'Time spent getting a connection from the pool, including opening a new one')
+
+
+class TimedPoolMixin:
+    """Records time spent waiting for a connection in db_pool_wait_seconds."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()  # noqa
+        finally:
+            pool_wait_histogram.observe(time.perf_counter() - started)
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
 
 
 # noinspection PyBroadException
@@ -150,14 +175,34 @@ class DBController:
         self.app_context = context
         self.logger.debug('DBController started.')
 
+    @property
+    def pool_options(self) -> dict:
+        db_config = self.app_context.db_config
+        return {
+            'pool_size': db_config.pool_size,
+            'max_overflow': db_config.max_overflow,
+            'pool_timeout': db_config.pool_timeout,
+            'pool_recycle': db_config.pool_recycle,
+            'pool_pre_ping': db_config.pool_pre_ping,
+        }
+
     @property
     def engine(self):
         if self.__engine is None:
             self.__engine = sa.create_engine(
                 self.app_context.db_config.db_con_string,
                 echo=False,
-                encoding='utf-8'
+                encoding='utf-8',
+                poolclass=TimedQueuePool,
+                **self.pool_options
             )
+            pool = self.__engine.pool
+            registry.gauge('db_pool_size', 'Connections kept open in the pool').set_function(pool.size)
+            registry.gauge('db_pool_checked_out', 'Connections in use').set_function(pool.checkedout)
+            registry.gauge('db_pool_checked_in', 'Idle connections in the pool').set_function(pool.checkedin)
+            registry.gauge(
+                'db_pool_overflow', 'Connections open above pool_size, negative while the pool is not full'
+            ).set_function(pool.overflow)
         return self.__engine
 
     @property
@@ -166,7 +211,9 @@ class DBController:
             self.__async_engine = asa.create_async_engine(
                 self.app_context.db_config.async_db_con_string,
                 echo=False,
-                encoding='utf-8'
+                encoding='utf-8',
+                poolclass=TimedAsyncAdaptedQueuePool,
+                **self.pool_options
             )
         return self.__async_engine
 
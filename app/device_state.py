@@ -0,0 +1,135 @@
+import threading
+import time
+from typing import Iterable, Optional
+
+from app.metrics import registry
+
+device_state_hits_counter = registry.counter(
+    'addreality_device_state_hits_total', 'Reads of device campaigns and campaign statuses served from memory')
+device_state_misses_counter = registry.counter(
+    'addreality_device_state_misses_total', 'Reads of device campaigns and campaign statuses sent to AddReality')
+
+
+class DeviceState:
+    """
+    Campaigns of devices and statuses of campaigns of one platform as last seen in AddReality.
+    Writes made by the service are applied right away, entries older than max_age seconds are not served,
+    so the state is never staler than max_age whatever the background refresh does.
+    Fetched snapshots are stored with the version read before fetching them and are dropped
+    if the service has written to the same entry in the meantime.
+    """
+
+    def __init__(self, platform_id: int, max_age: float, idle: float = 60.):
+        self.platform_id = platform_id
+        self.max_age = max_age
+        self.idle = idle
+        # device_id → campaign ids and the moment they have been fetched
+        self._devices: dict[int, tuple[list[int], float]] = {}
+        # device_id → the moment its campaigns have been read last
+        self._read_at: dict[int, float] = {}
+        self._statuses: Optional[dict[int, str]] = None
+        self._statuses_at = 0.
+        self._device_versions: dict[int, int] = {}
+        self._statuses_version = 0
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, fetched_at: float) -> bool:
+        return time.monotonic() - fetched_at < self.max_age
+
+    def device_version(self, device_id: int) -> int:
+        return self._device_versions.get(device_id, 0)
+
+    @property
+    def statuses_version(self) -> int:
+        return self._statuses_version
+
+    @property
+    def devices(self) -> list[int]:
+        """Devices whose campaigns are kept."""
+        return list(self._devices)
+
+    def refresh_targets(self, device_ids: Iterable[int] = ()) -> list[int]:
+        """
+        Drop devices not read for idle seconds, so the background refresh doesn't fetch every device ever switched.
+        :param device_ids: devices refreshed in any case, e.g. the ones with a slot booked
+        :return: the given devices and the devices read within idle seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            for device_id in [device_id for device_id, read_at in self._read_at.items() if now - read_at >= self.idle]:
+                del self._read_at[device_id]
+            targets = list(dict.fromkeys([*device_ids, *self._read_at]))
+            kept = set(targets)
+            for device_id in [device_id for device_id in self._devices if device_id not in kept]:
+                del self._devices[device_id]
+            return targets
+
+    def get_campaigns(self, device_id: int) -> Optional[list[int]]:
+        """
+        :param device_id: id of device
+        :return: ids of campaigns of the device or None if they have to be fetched
+        """
+        with self._lock:
+            self._read_at[device_id] = time.monotonic()
+            entry = self._devices.get(device_id)
+            if entry is None or not self._is_fresh(entry[1]):
+                device_state_misses_counter.inc()
+                return None
+            device_state_hits_counter.inc()
+            return list(entry[0])
+
+    def put_campaigns(self, device_id: int, campaign_ids: list[int], version: int) -> None:
+        """
+        :param version: device_version read before fetching campaign_ids
+        """
+        with self._lock:
+            if self._device_versions.get(device_id, 0) == version:
+                self._devices[device_id] = (list(campaign_ids), time.monotonic())
+
+    def get_statuses(self) -> Optional[dict[int, str]]:
+        """
+        :return: status by campaign id or None if the listing has to be fetched
+        """
+        with self._lock:
+            if self._statuses is None or not self._is_fresh(self._statuses_at):
+                device_state_misses_counter.inc()
+                return None
+            device_state_hits_counter.inc()
+            return dict(self._statuses)
+
+    def put_statuses(self, statuses: dict[int, str], version: int) -> None:
+        """
+        :param version: statuses_version read before fetching statuses
+        """
+        with self._lock:
+            if self._statuses_version == version:
+                self._statuses = dict(statuses)
+                self._statuses_at = time.monotonic()
+
+    def add_campaign(self, campaign_id: int, device_ids: Iterable[int], status: str) -> None:
+        with self._lock:
+            for device_id in device_ids:
+                self._device_versions[device_id] = self._device_versions.get(device_id, 0) + 1
+                entry = self._devices.get(device_id)
+                if entry is not None and campaign_id not in entry[0]:
+                    entry[0].append(campaign_id)
+            self._set_status(campaign_id, status)
+
+    def set_status(self, campaign_id: int, status: str) -> None:
+        with self._lock:
+            self._set_status(campaign_id, status)
+
+    def remove_campaign(self, campaign_id: int) -> None:
+        with self._lock:
+            for device_id, (campaign_ids, _) in self._devices.items():
+                if campaign_id in campaign_ids:
+                    campaign_ids.remove(campaign_id)
+                    self._device_versions[device_id] = self._device_versions.get(device_id, 0) + 1
+            self._statuses_version += 1
+            if self._statuses is not None:
+                self._statuses.pop(campaign_id, None)
+
+    def _set_status(self, campaign_id: int, status: str) -> None:
+        self._statuses_version += 1
+        if self._statuses is not None:
+            self._statuses[campaign_id] = status
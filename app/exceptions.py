@@ -5,3 +5,7 @@ class APIError(Exception):
         self.message = message
         self.code = code
         self.error_type = error_type
+
+
+class AddRealityError(Exception):
+    """Raised when request to AddReality API fails."""
@@ -1,26 +1,158 @@
+from typing import Optional
+
 import app.data_classes as dc
+from app import utils
+from app.metrics import CONTENT_TYPE, registry
+import app.main_section as main_sections
 from .base import BaseHandler
 
 
 class TurnOn(BaseHandler):
     async def post(self, device_id):
         device_id = int(device_id)
-        user_data = self.ms.get_authorization_params_by_id(device_id)
+        user_data = await self.get_publisher(device_id)
         filename = self.json_args['name']
         from_time = self.get_datetime_json_argument('start_date')
         to_time = self.get_datetime_json_argument('end_date')
         task = dc.TaskWrapper(dc.AdTaskConfig(filename, device_id, user_data, from_time, to_time), True)
-        self.tasks_queue.put(task)
-        await self.send_ok()
+        await self.enqueue([task])
+        await self.send_json({'msg': 'ok', 'task_id': task.id})
 
 
 class TurnOff(BaseHandler):
     async def post(self, device_id):
         device_id = int(device_id)
-        user_data = self.ms.get_authorization_params_by_id(device_id)
+        user_data = await self.get_publisher(device_id)
         filename = self.json_args['name']
         from_time = self.get_datetime_json_argument('start_date')
         to_time = self.get_datetime_json_argument('end_date')
         task = dc.TaskWrapper(dc.AdTaskConfig(filename, device_id, user_data, from_time, to_time), False)
-        self.tasks_queue.put(task)
+        await self.enqueue([task])
+        await self.send_json({'msg': 'ok', 'task_id': task.id})
+
+
+class BatchHandler(BaseHandler):
+    """Switch many devices by one request with body {"tasks": [{"device_id", "name", "start_date", "end_date"}]}."""
+    switch_to: bool
+
+    async def post(self):
+        entries = self.json_args['tasks']
+        device_ids = [int(entry['device_id']) for entry in entries]
+        users = await self.get_publishers(device_ids)
+
+        tasks = []
+        not_found = []
+        for entry in entries:
+            device_id = int(entry['device_id'])
+            if device_id not in users:
+                not_found.append(device_id)
+                continue
+            from_time = utils.datetime_from_string(entry.get('start_date'))
+            to_time = utils.datetime_from_string(entry.get('end_date'))
+            tasks.append(dc.TaskWrapper(
+                dc.AdTaskConfig(entry['name'], device_id, users[device_id], from_time, to_time), self.switch_to))
+
+        # tasks of one account go in a row, so they share its session and campaign listing
+        tasks.sort(key=lambda task_: (task_.task.user_data.login, task_.task.user_data.platform_id))
+        await self.enqueue(tasks)
+        await self.send_json({
+            'msg': 'ok',
+            'tasks': [{'device_id': task.task.device_id, 'task_id': task.id} for task in tasks],
+            'not_found': not_found,
+        })
+
+
+class BatchTurnOn(BatchHandler):
+    switch_to = True
+
+
+class BatchTurnOff(BatchHandler):
+    switch_to = False
+
+
+class InvalidatePublisher(BaseHandler):
+    """
+    Drop cached credentials of device, called after its publisher row has been changed.
+    In multi-process mode the other processes drop them as well.
+    """
+
+    async def post(self, device_id):
+        self.context.publishers_cache.invalidate(int(device_id))
+        if self.settings['invalidations'] is not None:
+            self.settings['invalidations'].publish(int(device_id))
         await self.send_ok()
+
+
+class TaskReadiness(BaseHandler):
+    async def get(self, task_id):
+        if self.ad_processor is None:
+            await self.send_json({'msg': 'Task status is served in single-process mode only'}, 501)
+            return
+        task = self.ad_processor.get_task(task_id)
+        if task is None:
+            await self.send_no_data()
+            return
+        await self.send_json({'task_id': task.id, 'readiness': task.readiness.value})
+
+
+class TaskStatus(BaseHandler):
+    """
+    State of task with timings of its stages. Tasks handled by this process are served from memory,
+    with the durable queue the others are read from the tasks table.
+    """
+
+    async def get(self, task_id):
+        task = self.ad_processor.get_task(task_id) if self.ad_processor is not None else None
+        if task is not None:
+            await self.send_json(task.report())
+            return
+        if not self.tasks_queue.durable:
+            if self.ad_processor is None:
+                await self.send_json({'msg': 'Task status is served in single-process mode only'}, 501)
+            else:
+                await self.send_no_data()
+            return
+
+        def read_report(ms: 'main_sections.MS') -> Optional[dict]:
+            row = ms.get_task(task_id)
+            return row.report() if row is not None else None
+
+        report = await self.run_ms(read_report)
+        if report is None:
+            await self.send_no_data()
+            return
+        await self.send_json(report)
+
+
+class DeviceTasks(BaseHandler):
+    """The latest tasks of device given by device_id argument, the latest first."""
+
+    async def get(self):
+        device_id = int(self.get_argument('device_id'))
+        limit = int(self.get_argument('limit', '100'))
+        if self.tasks_queue.durable:
+            reports = await self.run_ms(lambda ms: [row.report() for row in ms.get_device_tasks(device_id, limit)])
+            # tasks handled by this process are more recent in memory
+            if self.ad_processor is not None:
+                local = {task.id: task.report() for task in self.ad_processor.get_device_tasks(device_id)}
+                reports = [local.get(report['task_id'], report) for report in reports]
+        elif self.ad_processor is not None:
+            reports = [task.report() for task in self.ad_processor.get_device_tasks(device_id)[:limit]]
+        else:
+            await self.send_json({'msg': 'Task status is served in single-process mode only'}, 501)
+            return
+        await self.send_json({'device_id': device_id, 'tasks': reports})
+
+
+class Metrics(BaseHandler):
+    """Metrics of this process in Prometheus text format."""
+
+    async def get(self):
+        if self.settings['shared_port']:
+            await self.send_json(
+                {'msg': 'Metrics of HTTP processes are served on api.metrics_port + index of process'}, 501)
+            return
+        # gauges may query the DB, e.g. depth of the postgres queue
+        body = await self.run_in_executor(registry.exposition)
+        self.set_header('Content-Type', CONTENT_TYPE)
+        await self.finish(body)
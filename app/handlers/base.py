@@ -4,7 +4,6 @@ import pickle
 import sys
 from concurrent.futures.thread import ThreadPoolExecutor
 from datetime import datetime, date
-from queue import Queue
 from typing import Optional, Any, Callable
 
 from tornado import escape
@@ -13,12 +12,17 @@ from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler
 
 import app
+import app.data_classes as dc
 from app import utils, exceptions
+import app.ad_processor as ad_processor
 import app.db_controller as db_controller
 import app.main_section as main_sections
+import app.task_queue as task_queue
+from app.metrics import registry
 from sqlalchemy.orm import Session
 from app import context
 logger = logging.getLogger(__name__)
+request_buckets = (.001, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.)
 
 
 class BaseHandler(RequestHandler):
@@ -29,7 +33,7 @@ class BaseHandler(RequestHandler):
     context: 'app.AddRealityContext' = context
     asyncio_loop: asyncio.AbstractEventLoop
     executor: ThreadPoolExecutor
-    tasks_queue: Queue
+    tasks_queue: 'task_queue.MemoryTaskQueue | task_queue.PostgresTaskQueue'
 
     def initialize(self) -> None:
         self.tasks_queue = self.application.settings['tasks_queue']
@@ -91,6 +95,10 @@ class BaseHandler(RequestHandler):
     def executor(self):
         return self.settings['executor']
 
+    @property
+    def ad_processor(self) -> Optional['ad_processor.AdProcessor']:
+        return self.settings['ad_processor']
+
     async def run_async(self, f, *args, **kwargs) -> Any:
 
         if asyncio.iscoroutinefunction(f):
@@ -101,6 +109,54 @@ class BaseHandler(RequestHandler):
     async def run_in_executor(self, f: Callable, *args, **kwargs) -> Any:
         return await self.asyncio_loop.run_in_executor(self.executor, lambda: f(*args, **kwargs))
 
+    async def run_ms(self, f: Callable[['main_sections.MS'], Any]) -> Any:
+        """
+        Run main section query on executor within its own session, so the IOLoop never waits for the DB.
+        :param f: callable which gets MS
+        :return: result of f
+        """
+        def call():
+            with self.context.db_controller.with_sc() as sc:
+                return f(main_sections.MS(sc.session))
+        return await self.run_in_executor(call)
+
+    async def enqueue(self, task_wrappers: list['dc.TaskWrapper']) -> None:
+        """
+        Hand tasks to the processor, durable queue is written on executor by one insert.
+        :param task_wrappers: accepted tasks
+        """
+        if self.tasks_queue.durable:
+            await self.run_in_executor(self.tasks_queue.put, task_wrappers)
+        else:
+            self.tasks_queue.put(task_wrappers)
+
+    async def get_publisher(self, device_id: int) -> 'dc.User':
+        """
+        Credentials of device, the DB is queried on executor only if they are not cached.
+        :param device_id: id of device
+        :return: dc.User
+        """
+        user = self.context.publishers_cache.get(device_id)
+        if user is None:
+            user = await self.run_ms(lambda ms: ms.get_authorization_params_by_id(device_id, cached=False))
+        return user
+
+    async def get_publishers(self, device_ids: list[int]) -> dict[int, 'dc.User']:
+        """
+        Credentials of many devices, the ones not cached are fetched on executor by one query.
+        :param device_ids: ids of devices
+        :return: dict device_id → dc.User, unknown devices are missed
+        """
+        users = {}
+        for device_id in device_ids:
+            user = self.context.publishers_cache.get(device_id)
+            if user is not None:
+                users[device_id] = user
+        missed = [device_id for device_id in device_ids if device_id not in users]
+        if missed:
+            users.update(await self.run_ms(lambda ms: ms.get_authorization_params_by_ids(missed, cached=False)))
+        return users
+
     async def send_json(self, data, status: int = 200) -> None:
         self.set_header('Content-Type', 'application/json')
         self.set_status(status)
@@ -197,5 +253,10 @@ class BaseHandler(RequestHandler):
         return self.sc.session
 
     def on_finish(self):
+        registry.histogram(
+            'http_request_duration_seconds', 'Time of handling requests to the API by handler',
+            buckets=request_buckets,
+            handler=self.__class__.__name__, method=self.request.method, status=str(self.get_status()),
+        ).observe(self.request.request_time())
         if self.__sc_cm is not None:
             self.__sc_cm.__exit__(None, None, None)
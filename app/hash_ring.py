@@ -0,0 +1,32 @@
+import bisect
+import hashlib
+from typing import Generic, Iterable, TypeVar
+
+T = TypeVar('T')
+
+
+def stable_hash(key: str) -> int:
+    """Hash equal in every process, unlike hash() of str."""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing(Generic[T]):
+    """
+    Consistent hashing of keys onto nodes. Every node owns replicas points of the ring,
+    adding or removing a node moves only the keys of its points.
+    """
+
+    def __init__(self, nodes: Iterable[T], replicas: int = 100):
+        self._points: list[tuple[int, T]] = sorted(
+            (stable_hash(f'{node}:{i}'), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in self._points]
+        if not self._points:
+            raise ValueError('Hash ring has no nodes')
+
+    def owner(self, key) -> T:
+        """
+        :param key: device_id or any other value with stable str()
+        :return: node owning the key
+        """
+        i = bisect.bisect(self._hashes, stable_hash(str(key))) % len(self._points)
+        return self._points[i][1]
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from sqlalchemy.orm import Session
 
 import app
@@ -21,7 +23,17 @@ class MS:
             self.__logger = log_lib.get_logger(self.__class__.__name__)
         return self.__logger
 
-    def get_authorization_params_by_id(self, device_id: int):
+    def get_authorization_params_by_id(self, device_id: int, cached: bool = True):
+        """
+        :param device_id: id of device
+        :param cached: look up the cache first, False when the caller has just missed it
+        :return: dc.User
+        """
+        if cached:
+            user = self.context.publishers_cache.get(device_id)
+            if user is not None:
+                return user
+
         q_authorization = self.session.query(
             models.Publisher.login,
             models.Publisher.password,
@@ -30,8 +42,63 @@ class MS:
             models.Publisher.device_id == device_id
         ).first()
 
-        return dc.User(
+        user = dc.User(
             q_authorization.login,
             app.utils.decode_password(q_authorization.password),
             q_authorization.platform_id,
         )
+        self.context.publishers_cache.put(device_id, user)
+        return user
+
+    def get_authorization_params_by_ids(self, device_ids: list[int], cached: bool = True) -> dict[int, 'dc.User']:
+        """
+        Get credentials of many devices, the ones not cached are fetched by one query.
+        Devices of the same account share one dc.User, so its password is decrypted once.
+        :param device_ids: ids of devices
+        :param cached: look up the cache first, False when the caller has just missed it
+        :return: dict device_id → dc.User, unknown devices are missed
+        """
+        res = {}
+        if cached:
+            for device_id in device_ids:
+                user = self.context.publishers_cache.get(device_id)
+                if user is not None:
+                    res[device_id] = user
+            device_ids = [device_id for device_id in device_ids if device_id not in res]
+        if not device_ids:
+            return res
+
+        q_authorization = self.session.query(
+            models.Publisher.device_id,
+            models.Publisher.login,
+            models.Publisher.password,
+            models.Publisher.platform_id
+        ).filter(
+            models.Publisher.device_id.in_(device_ids)
+        ).all()
+
+        accounts: dict[tuple[str, bytes, int], 'dc.User'] = {}
+        for row in q_authorization:
+            key = (row.login, row.password, row.platform_id)
+            if key not in accounts:
+                accounts[key] = dc.User(
+                    row.login,
+                    app.utils.decode_password(row.password),
+                    row.platform_id,
+                )
+            res[row.device_id] = accounts[key]
+            self.context.publishers_cache.put(row.device_id, accounts[key])
+        return res
+
+    def get_task(self, task_id: str) -> Optional['models.Task']:
+        return self.session.query(models.Task).filter(models.Task.id == task_id).one_or_none()
+
+    def get_device_tasks(self, device_id: int, limit: int) -> list['models.Task']:
+        """
+        :return: the latest tasks of device in the tasks table, the latest first
+        """
+        return self.session.query(models.Task).filter(
+            models.Task.device_id == device_id
+        ).order_by(
+            models.Task.created_at.desc()
+        ).limit(limit).all()
@@ -0,0 +1,237 @@
+import bisect
+import itertools
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Union
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    """Monotonically increasing thread-safe counter."""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str = '', labels: dict[str, str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: Union[int, float] = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> Union[int, float]:
+        return self._value
+
+
+class Gauge:
+    """Value which can go up and down, or is read from a callback at collection time."""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str = '', labels: dict[str, str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self._value = 0
+        self._function: Optional[Callable[[], Union[int, float]]] = None
+        self._lock = threading.Lock()
+
+    def set(self, value: Union[int, float]) -> None:
+        self._value = value
+
+    def inc(self, amount: Union[int, float] = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: Union[int, float] = 1) -> None:
+        with self._lock:
+            self._value -= amount
+
+    def set_function(self, function: Callable[[], Union[int, float]]) -> None:
+        self._function = function
+
+    @property
+    def value(self) -> Union[int, float]:
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+
+class Histogram:
+    """Distribution of observed values over cumulative buckets."""
+    type = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str = '',
+            labels: dict[str, str] = None,
+            buckets: Optional[tuple[float, ...]] = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        # values of every bucket alone and above the last bound, summed up when collected
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            self._counts[i] += 1
+
+    @property
+    def bucket_counts(self) -> list[int]:
+        """Values not above every bound of buckets."""
+        return self.snapshot()[0]
+
+    def snapshot(self) -> tuple[list[int], float, int]:
+        """
+        :return: bucket_counts, sum and count consistent with each other
+        """
+        with self._lock:
+            counts, sum_, count = list(self._counts), self.sum, self.count
+        return list(itertools.accumulate(counts[:-1])), sum_, count
+
+    @property
+    def value(self) -> float:
+        """Mean of observed values."""
+        return self.sum / self.count if self.count else 0.
+
+
+class Registry:
+    """Process-wide storage of metrics, one instance per name and set of labels."""
+
+    def __init__(self):
+        self._metrics: dict[tuple, Union[Counter, Gauge, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str = '', **labels: str) -> 'Counter':
+        return self._get_or_create(Counter, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str = '', **labels: str) -> 'Gauge':
+        return self._get_or_create(Gauge, name, documentation, labels)
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str = '',
+            buckets: Optional[tuple[float, ...]] = None,
+            **labels: str,
+    ) -> 'Histogram':
+        return self._get_or_create(Histogram, name, documentation, labels, buckets=buckets)
+
+    def _get_or_create(self, metric_cls, name: str, documentation: str, labels: dict[str, str], **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = metric_cls(name, documentation, labels, **kwargs)
+                    self._metrics[key] = metric
+        return metric
+
+    def collect(self) -> list:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def exposition(self) -> str:
+        """
+        Metrics in Prometheus text format, metrics of one name go together under one HELP and TYPE.
+        Gauges whose callback fails are skipped.
+        :return: str
+        """
+        families: dict[str, list[Union[Counter, Gauge, Histogram]]] = {}
+        for metric in self.collect():
+            families.setdefault(metric.name, []).append(metric)
+
+        lines = []
+        for name, metrics in families.items():
+            documentation = metrics[0].documentation.replace('\\', '\\\\').replace('\n', '\\n')
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metrics[0].type}')
+            for metric in metrics:
+                if isinstance(metric, Histogram):
+                    bucket_counts, sum_, count = metric.snapshot()
+                    for bound, bucket_count in zip(metric.buckets, bucket_counts):
+                        labels = format_labels(metric.labels, le=format_value(bound))
+                        lines.append(f'{name}_bucket{labels} {bucket_count}')
+                    lines.append(f'{name}_bucket{format_labels(metric.labels, le="+Inf")} {count}')
+                    lines.append(f'{name}_sum{format_labels(metric.labels)} {format_value(sum_)}')
+                    lines.append(f'{name}_count{format_labels(metric.labels)} {count}')
+                    continue
+                try:
+                    value = metric.value
+                except Exception:
+                    # the source of the gauge is gone, e.g. the DB engine has been disposed
+                    continue
+                lines.append(f'{name}{format_labels(metric.labels)} {format_value(value)}')
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def escape(value: str) -> str:
+    """Escape label value, quotes are escaped in label values only."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: dict[str, str], **extra: str) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape(str(value))}"' for key, value in labels.items()) + '}'
+
+
+def format_value(value: Union[int, float]) -> str:
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if value.is_integer():
+            return f'{value:.1f}'
+    return str(value)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """GET /metrics of the registry for processes without the API."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    """
+    Serve /metrics on port from a daemon thread.
+    :param port: port to listen on
+    :return: server, shutdown() stops it
+    """
+    server = ThreadingHTTPServer(('', port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+registry = Registry()
@@ -1,2 +1,3 @@
 from .base import Base
 from .publisher import Publisher
+from .task import Task
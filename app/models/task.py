@@ -0,0 +1,78 @@
+import datetime
+from typing import Optional
+
+import sqlalchemy as sa
+
+import app.data_classes as dc
+import app.models as models
+
+
+class Task(models.Base):
+    """
+    Durable queue of switch tasks, rows are claimed by processors with SELECT ... FOR UPDATE SKIP LOCKED.
+    Tasks failed after all retries stay in it with status dead as the dead-letter store.
+    """
+    __tablename__ = 'tasks'
+    __table_args__ = (
+        sa.Index('ix_tasks_status_created_at', 'status', 'created_at'),
+    )
+
+    id = sa.Column(sa.String(32), primary_key=True)
+    device_id = sa.Column(sa.Integer(), nullable=False, index=True)
+    name = sa.Column(sa.String(), nullable=False)
+    from_time = sa.Column(sa.DateTime())
+    to_time = sa.Column(sa.DateTime())
+    switch_to = sa.Column(sa.Boolean(), nullable=False)
+    # processor process owning the device in multi-process mode, None if any processor can claim the task
+    partition = sa.Column(sa.Integer())
+    # pending, claimed, done, failed, superseded, expired or dead
+    status = sa.Column(sa.String(16), nullable=False, default='pending')
+    # times the task has been claimed
+    deliveries = sa.Column(sa.Integer(), nullable=False, default=0, server_default='0')
+    # error the task has been dead-lettered with
+    error = sa.Column(sa.String())
+    claimed_by = sa.Column(sa.String())
+    # heartbeat of the claiming processor, claims older than the lease are taken over
+    claimed_at = sa.Column(sa.DateTime())
+    created_at = sa.Column(sa.DateTime(), nullable=False, default=datetime.datetime.utcnow)
+    # the moment the campaign has been started
+    started_at = sa.Column(sa.DateTime())
+    completed_at = sa.Column(sa.DateTime())
+    # timings of the stages by name as TaskWrapper.stages_report, stored when the task is completed
+    stages = sa.Column(sa.JSON())
+
+    def __init__(
+            self,
+            id: str,
+            device_id: int,
+            name: str,
+            from_time: Optional[datetime.datetime],
+            to_time: Optional[datetime.datetime],
+            switch_to: bool,
+    ):
+        self.id = id
+        self.device_id = device_id
+        self.name = name
+        self.from_time = from_time
+        self.to_time = to_time
+        self.switch_to = switch_to
+
+    def report(self) -> dict:
+        """
+        :return: state of the task serializable to JSON, the stored part of TaskWrapper.report
+        """
+        return {
+            'task_id': self.id,
+            'device_id': self.device_id,
+            'name': self.name,
+            'switch_to': self.switch_to,
+            'from_time': dc.isoformat(self.from_time),
+            'to_time': dc.isoformat(self.to_time),
+            'status': self.status,
+            'created_at': dc.isoformat(self.created_at),
+            'started_at': dc.isoformat(self.started_at),
+            'completed_at': dc.isoformat(self.completed_at),
+            'deliveries': self.deliveries,
+            'error': self.error,
+            'stages': self.stages or {},
+        }
@@ -0,0 +1,166 @@
+import random
+import threading
+import time
+from typing import Optional
+
+from app import data_classes as dc
+from app.metrics import registry
+
+throttle_wait_histogram = registry.histogram(
+    'addreality_throttle_wait_seconds', 'Time requests to AddReality have waited for the rate limiter',
+    buckets=(0., .01, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.),
+)
+retry_delay_histogram = registry.histogram(
+    'addreality_retry_delay_seconds', 'Backoff before requests to AddReality are sent again',
+    buckets=(0., .1, .25, .5, 1., 2.5, 5., 10., 30.),
+)
+# other 5xx may come after the request has been applied, so only idempotent methods are repeated on them
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'))
+RETRIED_ALWAYS = frozenset((429, 503))
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate tokens per second up to burst. A request takes a token at once
+    and waits for the returned delay if the bucket has run dry, so threads and coroutines wait the same way.
+    The rate is halved when the server limits requests and recovers by a step on every success
+    up to the configured one, which keeps it close to the rate the server sustains.
+    """
+
+    def __init__(self, rate: float, burst: float, min_rate: float):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """
+        :return: seconds to wait before sending the request
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return 0. if self._tokens >= 0 else -self._tokens / self.rate
+
+    def has_spare(self, share: float) -> bool:
+        """
+        :param share: share of burst the bucket must hold
+        :return: whether the bucket holds at least that share, so a request can be sent without delaying others
+        """
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.burst * share
+
+    def slow_down(self) -> None:
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self) -> None:
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class Throttle:
+    """Rate limits of one AddReality account: its own bucket and the bucket shared by all accounts."""
+
+    def __init__(
+            self,
+            config: 'dc.AddRealityConfig',
+            account: Optional['TokenBucket'],
+            shared: Optional['TokenBucket'],
+    ):
+        self.config = config
+        self.account = account
+        self.shared = shared
+
+    def reserve(self) -> float:
+        """
+        Take a token of both buckets.
+        :return: seconds to wait before sending the request
+        """
+        delay = max(
+            self.account.reserve() if self.account is not None else 0.,
+            self.shared.reserve() if self.shared is not None else 0.,
+        )
+        throttle_wait_histogram.observe(delay)
+        return delay
+
+    def has_spare(self, share: float = .5) -> bool:
+        """
+        Whether both buckets are filled above share of their burst. Background requests are sent only then,
+        so they use the capacity left over by switches instead of competing with them.
+        :param share: share of burst the buckets must hold
+        :return: bool
+        """
+        return all(bucket.has_spare(share) for bucket in (self.account, self.shared) if bucket is not None)
+
+    def retry_delay(self, method: str, status: int, attempt: int, retry_after: Optional[str]) -> Optional[float]:
+        """
+        Adapt the rate of the account to the response and decide whether the request is sent again.
+        :param method: HTTP method of the request
+        :param status: status code of the response
+        :param attempt: number of the attempt starting from 0
+        :param retry_after: Retry-After header of the response
+        :return: seconds to wait before the next attempt or None if the response is final
+        """
+        if status == 429 and self.account is not None:
+            self.account.slow_down()
+        elif status < 500 and self.account is not None:
+            self.account.speed_up()
+
+        retried = status in RETRIED_ALWAYS or (status >= 500 and method in IDEMPOTENT_METHODS)
+        if not retried or attempt >= self.config.request_retries:
+            return None
+        # full jitter spreads the retries of requests limited at once
+        delay = random.uniform(0, min(self.config.retry_backoff_max, self.config.retry_backoff * 2 ** attempt))
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        registry.counter(
+            'addreality_retries_total', 'Requests to AddReality sent again after 429 or 5xx response',
+            status=str(status),
+        ).inc()
+        retry_delay_histogram.observe(delay)
+        return delay
+
+
+_shared: dict[tuple, 'TokenBucket'] = {}
+_accounts: dict[tuple, 'TokenBucket'] = {}
+_lock = threading.Lock()
+
+
+def throttle_of(config: 'dc.AddRealityConfig', platform_id: int, login: str) -> 'Throttle':
+    """
+    Throttle of the account, all sessions and clients of an account share its buckets.
+    A rate of 0 turns the limit off.
+    :param config: AddRealityConfig
+    :param platform_id: platform of the account
+    :param login: login of the account
+    :return: Throttle
+    """
+    with _lock:
+        shared = None
+        if config.global_rate_limit > 0:
+            key = (config.global_rate_limit, config.global_rate_burst)
+            shared = _shared.get(key)
+            if shared is None:
+                shared = _shared[key] = TokenBucket(
+                    config.global_rate_limit, config.global_rate_burst, config.min_rate_limit)
+        account = None
+        if config.rate_limit > 0:
+            key = (platform_id, login, config.rate_limit, config.rate_burst)
+            account = _accounts.get(key)
+            if account is None:
+                account = _accounts[key] = TokenBucket(config.rate_limit, config.rate_burst, config.min_rate_limit)
+    return Throttle(config, account, shared)
@@ -0,0 +1,99 @@
+import datetime
+import heapq
+import itertools
+import threading
+from functools import partial
+from typing import Callable
+
+import app.log_lib as log_lib
+
+
+class ScheduledJob:
+    def __init__(self, run_at: datetime.datetime, fn: Callable[[], None]):
+        self.run_at = run_at
+        self.fn = fn
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Fires jobs at their UTC time from a single thread backed by a priority queue.
+    Jobs must be short, long work has to be handed over to a worker pool.
+    """
+    __logger: 'log_lib' = None
+
+    def __init__(self, name: str = 'scheduler'):
+        self.alive = False
+        self._heap: list[tuple[datetime.datetime, int, 'ScheduledJob']] = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    @property
+    def logger(self) -> 'log_lib.Logger':
+        if self.__logger is None:
+            self.__logger = log_lib.get_logger(self.__class__.__name__)
+        return self.__logger
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, run_at: datetime.datetime, fn: Callable, *args, **kwargs) -> 'ScheduledJob':
+        """
+        Register job for the time in UTC, a past time fires at once.
+        :param run_at: UTC datetime, an aware one is converted to naive UTC
+        :param fn: callable to run
+        :return: ScheduledJob which can be cancelled until it has been fired
+        """
+        # a time not comparable with the others would break the queue for every job
+        if not isinstance(run_at, datetime.datetime):
+            raise TypeError(f'Time of job must be datetime, not {type(run_at).__name__}')
+        if run_at.tzinfo is not None:
+            run_at = run_at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        job = ScheduledJob(run_at, partial(fn, *args, **kwargs))
+        with self._condition:
+            heapq.heappush(self._heap, (run_at, next(self._counter), job))
+            # wake up the thread if the new job is the nearest one
+            if self._heap[0][2] is job:
+                self._condition.notify()
+        return job
+
+    def start(self) -> None:
+        self.alive = True
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self.alive = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while self.alive:
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    try:
+                        delay = (self._heap[0][0] - datetime.datetime.utcnow()).total_seconds()
+                    except Exception as ex:
+                        # a job with a broken time must not stop the jobs after it
+                        self.logger.exception(f'Scheduled job dropped: {ex!r}')
+                        heapq.heappop(self._heap)
+                        continue
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if not self.alive:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+            try:
+                job.fn()
+            except Exception as ex:
+                self.logger.exception(f'Scheduled job failed: {ex!r}')
@@ -0,0 +1,77 @@
+import threading
+
+import app.data_classes as dc
+from app.addreality_handler import AddRealityHandler
+from app.content_catalog import ContentCatalog
+from app.content_store import ContentStore
+from app.device_state import DeviceState
+from app.metrics import registry
+
+
+class SessionCache:
+    """
+    Authorized AddReality sessions shared between workers, one per (login, platform_id).
+    """
+
+    def __init__(self, config: 'dc.AddRealityConfig'):
+        self.config = config
+        self._handlers: dict[tuple[str, int], 'AddRealityHandler'] = {}
+        self._catalogs: dict[int, 'ContentCatalog'] = {}
+        self._device_states: dict[int, 'DeviceState'] = {}
+        self.content_store = ContentStore(config.content_store_path)
+        self._lock = threading.Lock()
+        self.hits = registry.counter(
+            'addreality_session_cache_hits_total', 'Tasks served by an already authorized session')
+        self.misses = registry.counter(
+            'addreality_session_cache_misses_total', 'Tasks which had to run the login handshake')
+        registry.gauge(
+            'addreality_sessions', 'AddReality sessions kept by the processor'
+        ).set_function(lambda: len(self._handlers))
+
+    def get(self, user: 'dc.User') -> 'AddRealityHandler':
+        """
+        Get authorized handler for user, log in only if there is no live session yet.
+        :param user: publisher credentials
+        :return: AddRealityHandler
+        """
+        key = (user.login, user.platform_id)
+        with self._lock:
+            handler = self._handlers.get(key)
+            # password of publisher has been changed, old session must not be reused
+            if handler is None or handler.data['password'] != user.password:
+                handler = AddRealityHandler(
+                    user, self.config, self.get_catalog(user.platform_id), self.content_store,
+                    self.get_device_state(user.platform_id))
+                self._handlers[key] = handler
+
+        if handler.ensure_authorized():
+            self.misses.inc()
+        else:
+            self.hits.inc()
+        return handler
+
+    def get_catalog(self, platform_id: int) -> 'ContentCatalog':
+        catalog = self._catalogs.get(platform_id)
+        if catalog is None:
+            catalog = self._catalogs.setdefault(platform_id, ContentCatalog(platform_id, self.config.content_ttl))
+        return catalog
+
+    def get_device_state(self, platform_id: int) -> 'DeviceState':
+        device_state = self._device_states.get(platform_id)
+        if device_state is None:
+            device_state = self._device_states.setdefault(
+                platform_id,
+                DeviceState(platform_id, self.config.device_state_max_age, self.config.device_state_idle))
+        return device_state
+
+    def platform_handlers(self) -> list['AddRealityHandler']:
+        """
+        One authorized handler of every platform, to refresh the state shared by sessions of the platform.
+        :return: list['AddRealityHandler']
+        """
+        with self._lock:
+            handlers = {}
+            for handler in self._handlers.values():
+                if handler.is_authorized:
+                    handlers.setdefault(handler.platform_id, handler)
+            return list(handlers.values())
@@ -0,0 +1,292 @@
+import datetime
+import multiprocessing
+import socket
+import time
+from collections import OrderedDict, defaultdict
+from queue import Empty, Queue
+from typing import Optional
+
+import sqlalchemy as sa
+
+import app
+import app.data_classes as dc
+import app.log_lib as log_lib
+import app.main_section as main_section
+import app.models as models
+from app.hash_ring import HashRing
+
+
+class MemoryTaskQueue:
+    """Tasks handed from the API to the processor of the same process, they are lost on restart."""
+    durable = False
+
+    def __init__(self, dead_letters_size: int = 1000):
+        self._queue: Queue['dc.TaskWrapper'] = Queue()
+        # the latest tasks failed after all retries by id
+        self.dead_letters: OrderedDict[str, 'dc.TaskWrapper'] = OrderedDict()
+        self.dead_letters_size = dead_letters_size
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def put(self, task_wrappers: list['dc.TaskWrapper']) -> None:
+        for task_wrapper in task_wrappers:
+            self._queue.put(task_wrapper)
+
+    def get(self, timeout: float = .25) -> list['dc.TaskWrapper']:
+        try:
+            return [self._queue.get(timeout=timeout)]
+        except Empty:
+            return []
+
+    def complete(self, task_wrapper: 'dc.TaskWrapper', status: str) -> None:
+        pass
+
+    def record_start(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        pass
+
+    def dead_letter(self, task_wrapper: 'dc.TaskWrapper', error: str) -> None:
+        self.dead_letters[task_wrapper.id] = task_wrapper
+        while len(self.dead_letters) > self.dead_letters_size:
+            self.dead_letters.popitem(last=False)
+
+    def renew(self) -> None:
+        pass
+
+    def restore(self) -> None:
+        pass
+
+
+class ProcessTaskQueue(MemoryTaskQueue):
+    """Tasks of the devices owned by one processor process, sent in batches by PartitionedTaskQueue."""
+
+    def __init__(self, queue: 'multiprocessing.Queue[list[dc.TaskWrapper]]', dead_letters_size: int = 1000):
+        super().__init__(dead_letters_size)
+        self._queue = queue
+
+    def put(self, task_wrappers: list['dc.TaskWrapper']) -> None:
+        self._queue.put(task_wrappers)
+
+    def get(self, timeout: float = .25) -> list['dc.TaskWrapper']:
+        try:
+            return self._queue.get(timeout=timeout)
+        except Empty:
+            return []
+
+
+class PartitionedTaskQueue:
+    """
+    Front of multi-process mode: tasks of every device go to the processor process owning it on the hash ring,
+    so tasks of one device are never handled by two processes.
+    """
+    durable = False
+
+    def __init__(self, queues: list['multiprocessing.Queue[list[dc.TaskWrapper]]'], ring: 'HashRing[int]'):
+        """
+        :param queues: queue of every processor process by its index
+        :param ring: hash ring of processor indexes
+        """
+        self.queues = queues
+        self.ring = ring
+
+    def qsize(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def put(self, task_wrappers: list['dc.TaskWrapper']) -> None:
+        batches: dict[int, list['dc.TaskWrapper']] = defaultdict(list)
+        for task_wrapper in task_wrappers:
+            batches[self.ring.owner(task_wrapper.task.device_id)].append(task_wrapper)
+        for partition, batch in batches.items():
+            self.queues[partition].put(batch)
+
+
+class PostgresTaskQueue:
+    """
+    Tasks stored in the tasks table, so accepted and scheduled switches survive restarts and
+    several processors share them. A processor claims pending rows with SELECT ... FOR UPDATE SKIP LOCKED,
+    keeps its claims alive by heartbeat and marks them completed when their slot is over.
+    Claims whose heartbeat is older than the lease are taken over by other processors.
+    Tasks failed after all retries or claimed more than queue_max_deliveries times are kept with status dead.
+    """
+    durable = True
+    __logger: 'log_lib' = None
+
+    def __init__(
+            self,
+            config: 'dc.ProcessorConfig',
+            ring: Optional['HashRing[int]'] = None,
+            partition: Optional[int] = None,
+    ):
+        """
+        :param ring: hash ring of processor processes, tasks are stored with the partition owning their device
+        :param partition: index of this processor process, only tasks of the partition are claimed
+        """
+        self.config = config
+        self.ring = ring
+        self.partition = partition
+        self.worker_id = config.worker_id or socket.gethostname()
+        if partition is not None:
+            self.worker_id = f'{self.worker_id}-{partition}'
+
+    @property
+    def logger(self) -> 'log_lib.Logger':
+        if self.__logger is None:
+            self.__logger = log_lib.get_logger(self.__class__.__name__)
+        return self.__logger
+
+    def qsize(self) -> int:
+        with app.context.sc as sc:
+            return sc.session.query(sa.func.count(models.Task.id)).filter(models.Task.status == 'pending').scalar()
+
+    def put(self, task_wrappers: list['dc.TaskWrapper']) -> None:
+        """
+        Store tasks by one multi-row insert.
+        :param task_wrappers: tasks accepted by the API
+        :return: None
+        """
+        if not task_wrappers:
+            return
+        with app.context.sc as sc:
+            sc.session.execute(sa.insert(models.Task), [{
+                'id': task_wrapper.id,
+                'device_id': task_wrapper.task.device_id,
+                'name': task_wrapper.task.name,
+                'from_time': task_wrapper.task.from_time,
+                'to_time': task_wrapper.task.to_time,
+                'switch_to': task_wrapper.switch_to,
+                'partition': self.ring.owner(task_wrapper.task.device_id) if self.ring is not None else None,
+                'status': 'pending',
+                'created_at': task_wrapper.created_at,
+            } for task_wrapper in task_wrappers])
+            # the API answers only after tasks are stored
+            sc.commit()
+
+    def get(self) -> list['dc.TaskWrapper']:
+        """
+        Claim up to queue_batch_size tasks in order of arrival, wait for queue_poll_interval if there are none.
+        :return: list['dc.TaskWrapper']
+        """
+        now = datetime.datetime.utcnow()
+        expired = now - datetime.timedelta(seconds=self.config.queue_lease)
+        task = models.Task
+        claimable = sa.select(task.id).where(sa.or_(
+            task.status == 'pending',
+            sa.and_(task.status == 'claimed', task.claimed_at < expired),
+        ))
+        if self.partition is not None:
+            claimable = claimable.where(task.partition == self.partition)
+        claimable = claimable.order_by(task.created_at).limit(self.config.queue_batch_size).with_for_update(
+            skip_locked=True)
+        with app.context.sc as sc:
+            rows = sc.session.execute(
+                sa.update(task)
+                .where(task.id.in_(claimable.scalar_subquery()))
+                .values(status='claimed', claimed_by=self.worker_id, claimed_at=now, deliveries=task.deliveries + 1)
+                .returning(task.id, task.device_id, task.name, task.from_time, task.to_time, task.switch_to,
+                           task.created_at, task.deliveries)
+                .execution_options(synchronize_session=False)
+            ).all()
+            if not rows:
+                time.sleep(self.config.queue_poll_interval)
+                return []
+            users = main_section.MS(sc.session).get_authorization_params_by_ids([row.device_id for row in rows])
+
+        task_wrappers = []
+        for row in sorted(rows, key=lambda row_: row_.created_at):
+            task_wrapper = dc.TaskWrapper(
+                dc.AdTaskConfig(row.name, row.device_id, users.get(row.device_id), row.from_time, row.to_time),
+                row.switch_to,
+                id=row.id,
+                deliveries=row.deliveries,
+                created_at=row.created_at,
+            )
+            if task_wrapper.task.user_data is None:
+                self.logger.error(f'Task {row.id}: device {row.device_id} has no publisher')
+                self.complete(task_wrapper, 'failed')
+                continue
+            if row.deliveries > self.config.queue_max_deliveries:
+                self.logger.error(f'Task {row.id}: claimed {row.deliveries} times, dead-lettered')
+                self.dead_letter(task_wrapper, f'claimed {row.deliveries} times')
+                continue
+            task_wrappers.append(task_wrapper)
+        return task_wrappers
+
+    def complete(self, task_wrapper: 'dc.TaskWrapper', status: str) -> None:
+        """
+        :param status: done, failed or superseded
+        """
+        with app.context.sc as sc:
+            sc.session.execute(
+                sa.update(models.Task)
+                .where(models.Task.id == task_wrapper.id)
+                .values(
+                    status=status,
+                    started_at=task_wrapper.started_at,
+                    completed_at=datetime.datetime.utcnow(),
+                    stages=task_wrapper.stages_report(),
+                )
+                .execution_options(synchronize_session=False)
+            )
+
+    def record_start(self, task_wrapper: 'dc.TaskWrapper') -> None:
+        """
+        Store the start of the campaign and the stages so far, the task stays claimed till its slot is over.
+        """
+        with app.context.sc as sc:
+            sc.session.execute(
+                sa.update(models.Task)
+                .where(models.Task.id == task_wrapper.id)
+                .values(started_at=task_wrapper.started_at, stages=task_wrapper.stages_report())
+                .execution_options(synchronize_session=False)
+            )
+
+    def dead_letter(self, task_wrapper: 'dc.TaskWrapper', error: str) -> None:
+        """
+        Keep failed task with status dead and its error.
+        """
+        with app.context.sc as sc:
+            sc.session.execute(
+                sa.update(models.Task)
+                .where(models.Task.id == task_wrapper.id)
+                .values(
+                    status='dead',
+                    error=error,
+                    completed_at=datetime.datetime.utcnow(),
+                    stages=task_wrapper.stages_report(),
+                )
+                .execution_options(synchronize_session=False)
+            )
+
+    def renew(self) -> None:
+        """Extend the lease of tasks claimed by this processor."""
+        with app.context.sc as sc:
+            sc.session.execute(
+                sa.update(models.Task)
+                .where(models.Task.status == 'claimed', models.Task.claimed_by == self.worker_id)
+                .values(claimed_at=datetime.datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+
+    def restore(self) -> None:
+        """
+        Return tasks claimed by this processor before restart to the queue, they are claimed again
+        in order of arrival and their schedule is rebuilt.
+        """
+        with app.context.sc as sc:
+            restored = sc.session.execute(
+                sa.update(models.Task)
+                .where(models.Task.status == 'claimed', models.Task.claimed_by == self.worker_id)
+                .values(status='pending', claimed_by=None, claimed_at=None)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+        self.logger.info(f'{restored} tasks of {self.worker_id} have been restored')
+
+
+def make_task_queue(config: 'dc.ProcessorConfig'):
+    """
+    :param config: ProcessorConfig
+    :return: PostgresTaskQueue if queue is postgres, MemoryTaskQueue otherwise
+    """
+    if config.queue == 'postgres':
+        return PostgresTaskQueue(config)
+    return MemoryTaskQueue(config.dead_letters_size)
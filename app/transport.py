@@ -0,0 +1,65 @@
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from app import data_classes as dc
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter which turns on TCP keep-alive, so idle pooled connections are not dropped silently."""
+
+    def __init__(self, keepalive_idle: int, **kwargs):
+        self.keepalive_idle = keepalive_idle
+        super().__init__(**kwargs)
+
+    @property
+    def socket_options(self) -> list[tuple[int, int, int]]:
+        options = list(HTTPConnection.default_socket_options)
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        # TCP_KEEPIDLE is not available on every platform
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive_idle))
+        return options
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+_adapters: dict[tuple, 'KeepAliveAdapter'] = {}
+_lock = threading.Lock()
+
+
+def shared_adapter(config: 'dc.AddRealityConfig') -> 'KeepAliveAdapter':
+    """
+    Adapter shared by sessions with the same pool settings. Its connection pool is thread-safe,
+    so sessions of all accounts reuse connections to AddReality while cookies stay per session.
+    :param config: AddRealityConfig
+    :return: KeepAliveAdapter
+    """
+    key = (config.http_pool_connections, config.http_pool_maxsize, config.http_keepalive_idle)
+    with _lock:
+        adapter = _adapters.get(key)
+        if adapter is None:
+            adapter = KeepAliveAdapter(
+                config.http_keepalive_idle,
+                pool_connections=config.http_pool_connections,
+                pool_maxsize=config.http_pool_maxsize,
+            )
+            _adapters[key] = adapter
+        return adapter
+
+
+def new_session(config: 'dc.AddRealityConfig') -> 'requests.Session':
+    """
+    :param config: AddRealityConfig
+    :return: requests.Session over the shared adapter
+    """
+    session = requests.session()
+    adapter = shared_adapter(config)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, TypeVar
+
+from app.metrics import Counter
+
+T = TypeVar('T')
+
+
+class TTLCache(Generic[T]):
+    """
+    Thread-safe LRU cache whose entries also expire ttl seconds after they have been put.
+    Every get is counted by hits and misses counters if they are given.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, hits: Optional['Counter'] = None, misses: Optional['Counter'] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = hits
+        self.misses = misses
+        self._data: OrderedDict[Hashable, tuple[float, T]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[T]:
+        value = self._get(key)
+        counter = self.hits if value is not None else self.misses
+        if counter is not None:
+            counter.inc()
+        return value
+
+    def _get(self, key: Hashable) -> Optional[T]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: T) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,56 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+
+class UploadJournal:
+    """
+    Chunks of a file acknowledged by AddReality, persisted on disk after every chunk,
+    so an interrupted upload continues from where it has stopped.
+    """
+
+    def __init__(self, directory: str, platform_id: int, file_path: str, chunk_size: int):
+        stat = os.stat(file_path)
+        # a changed file or another chunk size never resumes an old upload
+        key = f'{platform_id}:{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}:{chunk_size}'
+        self.path = os.path.join(directory, f'{hashlib.sha1(key.encode()).hexdigest()}.json')
+        self.file_id: Optional[int] = None
+        self.acked: set[int] = set()
+        # whether chunks of a previous run have been found on disk
+        self.resumed = False
+        self._lock = threading.Lock()
+
+        with contextlib.suppress(FileNotFoundError, ValueError, KeyError):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.file_id = state['file_id']
+            self.acked = set(state['acked'])
+            self.resumed = bool(self.acked)
+
+    def ack(self, index: int, file_id: Optional[int] = None) -> None:
+        with self._lock:
+            if file_id is not None:
+                self.file_id = file_id
+            self.acked.add(index)
+            self._save()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.file_id = None
+            self.acked = set()
+            self.resumed = False
+            self.remove()
+
+    def remove(self) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'file_id': self.file_id, 'acked': sorted(self.acked)}, f)
+        os.replace(tmp_path, self.path)
@@ -1,4 +1,5 @@
-from datetime import datetime, date
+from datetime import datetime, date, timezone
+from functools import lru_cache
 from random import random
 from typing import Optional, TypeVar
 
@@ -14,15 +15,19 @@ context = app.context
 def datetime_from_string(ts: str, verify: bool = False) -> Optional[datetime]:
     """
     Convert time string to datetime with check on empty source string.
+    A time with UTC offset is converted to UTC, the service compares naive UTC datetimes only.
     :param ts: time string
     :param verify: verify if date string is empty
-    :return: datetime
+    :return: naive datetime
     """
     if ts:
         try:
-            return datetime.fromisoformat(ts)
+            value = datetime.fromisoformat(ts)
         except ValueError:
             raise exceptions.APIError(f'Date argument is not correct.')
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
     elif verify:
         raise exceptions.APIError(f'Date argument are missed.')
     return None
@@ -70,13 +75,18 @@ def read_in_chunks(file_object, chunk_size):
         yield data
 
 
+@lru_cache(maxsize=1)
+def _fernet(secret_key: str) -> Fernet:
+    return Fernet(secret_key)
+
+
 def encode_password(password: str):
-    f = Fernet(context.secret_key)
+    f = _fernet(context.secret_key)
     encrypted_pass = f.encrypt(password.encode('utf-8'))
     return encrypted_pass
 
 
 def decode_password(password: bytes):
-    f = Fernet(context.secret_key)
+    f = _fernet(context.secret_key)
     decrypted_pass = f.decrypt(password)
     return decrypted_pass.decode('utf-8')
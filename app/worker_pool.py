@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import deque
+from functools import partial
+from typing import Callable, Hashable
+
+import app.log_lib as log_lib
+from app.metrics import registry
+
+
+class KeyedWorkerPool:
+    """
+    Pool of worker threads. Jobs submitted with the same key run strictly one after another
+    in submission order, jobs with different keys run in parallel.
+    """
+    __logger: 'log_lib' = None
+
+    def __init__(self, workers: int, name: str = 'worker'):
+        self.name = name
+        self.alive = False
+        self._pending: dict[Hashable, deque[Callable[[], None]]] = {}
+        # keys which have pending jobs and no running one
+        self._ready: deque[Hashable] = deque()
+        self._running: set[Hashable] = set()
+        self._condition = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'{name}-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        # its rate divided by workers is the utilization of the pool
+        self._busy_seconds = registry.counter(
+            'worker_pool_busy_seconds_total', 'Time workers have spent running jobs', pool=name)
+
+    @property
+    def logger(self) -> 'log_lib.Logger':
+        if self.__logger is None:
+            self.__logger = log_lib.get_logger(self.__class__.__name__)
+        return self.__logger
+
+    @property
+    def workers(self) -> int:
+        return len(self._threads)
+
+    @property
+    def queue_depth(self) -> int:
+        """Jobs waiting for a worker."""
+        with self._condition:
+            return sum(len(jobs) for jobs in self._pending.values())
+
+    @property
+    def in_flight(self) -> int:
+        """Jobs being executed right now."""
+        return len(self._running)
+
+    def submit(self, key: Hashable, fn: Callable, *args, **kwargs) -> None:
+        with self._condition:
+            jobs = self._pending.setdefault(key, deque())
+            jobs.append(partial(fn, *args, **kwargs))
+            if len(jobs) == 1 and key not in self._running:
+                self._ready.append(key)
+                self._condition.notify()
+
+    def start(self) -> None:
+        self.alive = True
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """Stop workers after their current jobs, jobs which have not started are dropped."""
+        with self._condition:
+            self.alive = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _worker(self) -> None:
+        while True:
+            with self._condition:
+                while self.alive and not self._ready:
+                    self._condition.wait()
+                if not self.alive:
+                    return
+                key = self._ready.popleft()
+                job = self._pending[key].popleft()
+                self._running.add(key)
+            started = time.perf_counter()
+            try:
+                job()
+            except Exception as ex:
+                self.logger.exception(f'Job {key} failed: {ex!r}')
+            finally:
+                self._busy_seconds.inc(time.perf_counter() - started)
+                with self._condition:
+                    self._running.discard(key)
+                    if self._pending[key]:
+                        self._ready.append(key)
+                        self._condition.notify()
+                    else:
+                        del self._pending[key]
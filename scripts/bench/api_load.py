@@ -0,0 +1,91 @@
+# Load benchmark of the API
+#
+# Starts the API in a child process without the task processor, so no task reaches AddReality,
+# then sends POST /turn_on/<device_id> from --concurrency clients for --duration seconds
+# and prints requests/sec and latency percentiles.
+# Devices must exist in the publishers table. Run it on two commits to compare them.
+
+import asyncio
+import json
+import multiprocessing
+import statistics
+import time
+from argparse import ArgumentParser
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='API load benchmark')
+    parser.add_argument('--port', '-p', help='port of API started by benchmark', type=int, default=4100)
+    parser.add_argument('--device-id', '-d', help='devices to switch', type=int, nargs='+', required=True)
+    parser.add_argument('--name', help='content name sent in requests', default='content/3_1.png')
+    parser.add_argument('--concurrency', '-c', help='requests in flight', type=int, default=50)
+    parser.add_argument('--duration', '-t', help='seconds to run', type=float, default=10.)
+    return parser.parse_args()
+
+
+def serve(port: int) -> None:
+    from tornado.ioloop import IOLoop
+
+    import app
+    from app.application import App
+
+    async def start():
+        App(port=port)
+        app.context.load_db_controller()
+
+    IOLoop.current().run_sync(start)
+    IOLoop.current().start()
+
+
+async def load(args) -> tuple[list[float], int]:
+    AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+    client = AsyncHTTPClient()
+    body = json.dumps({'name': args.name})
+    latencies: list[float] = []
+    errors = 0
+    deadline = time.monotonic() + args.duration
+
+    async def worker(n: int):
+        nonlocal errors
+        i = n
+        while time.monotonic() < deadline:
+            device_id = args.device_id[i % len(args.device_id)]
+            i += args.concurrency
+            started = time.monotonic()
+            try:
+                await client.fetch(
+                    f'http://127.0.0.1:{args.port}/turn_on/{device_id}',
+                    method='POST',
+                    body=body,
+                    headers={'Content-Type': 'application/json'},
+                )
+            except HTTPClientError:
+                errors += 1
+            latencies.append(time.monotonic() - started)
+
+    await asyncio.gather(*(worker(n) for n in range(args.concurrency)))
+    return latencies, errors
+
+
+def main():
+    args = parse_arguments()
+    server = multiprocessing.Process(target=serve, args=(args.port,), daemon=True)
+    server.start()
+    time.sleep(2)
+    try:
+        latencies, errors = asyncio.run(load(args))
+    finally:
+        server.terminate()
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    print(f'requests: {len(latencies)}, errors: {errors}')
+    print(f'requests/sec: {len(latencies) / args.duration:.1f}')
+    print(f'latency ms p50: {quantiles[49] * 1000:.1f}, p95: {quantiles[94] * 1000:.1f}, '
+          f'p99: {quantiles[98] * 1000:.1f}')
+
+
+if __name__ == '__main__':
+    main()
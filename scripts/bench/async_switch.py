@@ -0,0 +1,120 @@
+# Switch benchmark of AddReality clients against the mock API
+#
+# Starts scripts/utils/mock_addreality.py in a child process, then switches --devices devices to a new campaign
+# at once with AsyncAddRealityHandler on the IOLoop, or with AddRealityHandler on --threads threads if --sync is set.
+# Prints switches/sec and checks that every device ends with exactly one playing campaign.
+# --mock-rate-limit makes the mock answer 429 above that many requests/sec, --rate-limit limits the client,
+# retries and throttle wait of the client are printed then.
+
+import asyncio
+import multiprocessing
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import app.data_classes as dc
+from app import campaign_generator
+from app.addreality_handler import AddRealityHandler
+from app.async_addreality_handler import AsyncAddRealityHandler
+from app.content_catalog import ContentCatalog
+from app.metrics import registry
+from scripts.utils.mock_addreality import serve
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Switch benchmark of AddReality clients')
+    parser.add_argument('--port', '-p', help='port of mock API started by benchmark', type=int, default=4200)
+    parser.add_argument('--devices', '-d', help='devices switched at once', type=int, default=500)
+    parser.add_argument('--latency', '-l', help='seconds every mock response is delayed by', type=float, default=.05)
+    parser.add_argument('--rounds', '-r', help='switches of every device', type=int, default=2)
+    parser.add_argument('--sync', help='use blocking client on threads', action='store_true')
+    parser.add_argument('--threads', help='threads of blocking client', type=int, default=8)
+    parser.add_argument('--rate-limit', help='requests/sec of the client, 0 is unlimited', type=float, default=0.)
+    parser.add_argument('--mock-rate-limit', help='requests/sec served by the mock, 0 serves all', type=int,
+                        default=0)
+    return parser.parse_args()
+
+
+def make_task(device_id: int, content_path: str) -> 'dc.AdTaskConfig':
+    return dc.AdTaskConfig(content_path, device_id, dc.User('bench', 'bench', 1), None, None)
+
+
+async def run_async(args, config: 'dc.AddRealityConfig', content_path: str) -> 'AsyncAddRealityHandler':
+    handler = AsyncAddRealityHandler(dc.User('bench', 'bench', 1), config, ContentCatalog(1, config.content_ttl))
+    await handler.ensure_authorized()
+
+    async def switch(device_id: int):
+        task = make_task(device_id, content_path)
+        content_id = await handler.add_content(task.name)
+        await handler.delete_campaigns(await handler.get_device_info(device_id))
+        await handler.add_and_start_campaign(campaign_generator.create_campaign(content_id, task))
+
+    for _ in range(args.rounds):
+        await asyncio.gather(*(switch(device_id) for device_id in range(1, args.devices + 1)))
+    return handler
+
+
+def run_sync(args, config: 'dc.AddRealityConfig', content_path: str) -> 'AddRealityHandler':
+    handler = AddRealityHandler(dc.User('bench', 'bench', 1), config, ContentCatalog(1, config.content_ttl))
+    handler.ensure_authorized()
+
+    def switch(device_id: int):
+        task = make_task(device_id, content_path)
+        content_id = handler.add_content(task.name)
+        handler.delete_campaigns(handler.get_device_info(device_id))
+        handler.add_and_start_campaign(campaign_generator.create_campaign(content_id, task))
+
+    with ThreadPoolExecutor(args.threads) as executor:
+        for _ in range(args.rounds):
+            list(executor.map(switch, range(1, args.devices + 1)))
+    return handler
+
+
+def main():
+    args = parse_arguments()
+    server = multiprocessing.Process(
+        target=serve, args=(args.port, args.devices, args.latency, args.mock_rate_limit), daemon=True)
+    server.start()
+    time.sleep(1)
+
+    config = dc.AddRealityConfig(
+        api_url=f'http://127.0.0.1:{args.port}', rate_limit=args.rate_limit, global_rate_limit=0)
+    with tempfile.NamedTemporaryFile(suffix='.png') as content:
+        content.write(b'0' * 1000)
+        content.flush()
+        started = time.monotonic()
+        try:
+            if args.sync:
+                handler = run_sync(args, config, content.name)
+                elapsed = time.monotonic() - started
+                devices = {device_id: handler.get_device_info(device_id, force=True)
+                           for device_id in range(1, args.devices + 1)}
+                statuses = handler.get_campaign_statuses(force=True)
+            else:
+                async def run():
+                    async_handler = await run_async(args, config, content.name)
+                    return (
+                        time.monotonic() - started,
+                        {device_id: await async_handler.get_device_info(device_id, force=True)
+                         for device_id in range(1, args.devices + 1)},
+                        await async_handler.get_campaign_statuses(force=True),
+                    )
+                elapsed, devices, statuses = asyncio.run(run())
+        finally:
+            server.terminate()
+
+    switches = args.devices * args.rounds
+    broken = [device_id for device_id, campaigns in devices.items()
+              if len(campaigns) != 1 or statuses.get(campaigns[0]) != 'playing']
+    print(f'client: {"sync, %d threads" % args.threads if args.sync else "async"}')
+    print(f'switches: {switches} in {elapsed:.2f}s, switches/sec: {switches / elapsed:.1f}')
+    print(f'devices without exactly one playing campaign: {len(broken)}')
+    metrics = registry.collect()
+    retries = sum(metric.value for metric in metrics if metric.name == 'addreality_retries_total')
+    wait = sum(metric.sum for metric in metrics if metric.name == 'addreality_throttle_wait_seconds')
+    print(f'retries: {retries}, throttle wait: {wait:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# Campaign creation benchmark against the mock API
+#
+# Starts scripts/utils/mock_addreality.py in a child process and creates and starts --switches campaigns
+# with AddRealityHandler.add_and_start_campaign in every campaign_create_mode.
+# Prints requests and wall time per switch for each mode.
+
+import multiprocessing
+import time
+from argparse import ArgumentParser
+
+import app.data_classes as dc
+from app import campaign_generator
+from app.addreality_handler import AddRealityHandler
+from app.metrics import registry
+from scripts.utils.mock_addreality import serve
+
+MODES = ('full', 'compact')
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Campaign creation benchmark')
+    parser.add_argument('--port', '-p', help='port of mock API started by benchmark', type=int, default=4200)
+    parser.add_argument('--switches', '-s', help='campaigns created in every mode', type=int, default=50)
+    parser.add_argument('--latency', '-l', help='seconds every mock response is delayed by', type=float, default=.05)
+    return parser.parse_args()
+
+
+def requests_sent() -> int:
+    return sum(metric.count for metric in registry.collect() if metric.name == 'addreality_request_seconds')
+
+
+def run(args, mode: str) -> tuple[float, float]:
+    config = dc.AddRealityConfig(
+        api_url=f'http://127.0.0.1:{args.port}', campaign_create_mode=mode, rate_limit=0, global_rate_limit=0)
+    handler = AddRealityHandler(dc.User('bench', 'bench', 1), config)
+    handler.ensure_authorized()
+
+    sent = requests_sent()
+    started = time.monotonic()
+    for i in range(args.switches):
+        task = dc.AdTaskConfig('bench.png', i % 5 + 1, None, None, None)
+        handler.add_and_start_campaign(campaign_generator.create_campaign(1, task))
+    elapsed = time.monotonic() - started
+    sent = requests_sent() - sent
+
+    statuses = handler.get_campaign_statuses(force=True)
+    assert all(status == 'playing' for status in statuses.values()), 'not every campaign is playing'
+    handler.delete_campaigns(list(statuses))
+    return sent / args.switches, elapsed / args.switches
+
+
+def main():
+    args = parse_arguments()
+    server = multiprocessing.Process(target=serve, args=(args.port, 5, args.latency), daemon=True)
+    server.start()
+    time.sleep(1)
+    try:
+        results = {mode: run(args, mode) for mode in MODES}
+    finally:
+        server.terminate()
+
+    for mode, (requests_per_switch, seconds_per_switch) in results.items():
+        print(f'{mode}: requests/switch: {requests_per_switch:.1f}, ms/switch: {seconds_per_switch * 1000:.1f}')
+
+
+if __name__ == '__main__':
+    main()
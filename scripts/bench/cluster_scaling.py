@@ -0,0 +1,142 @@
+# Throughput of multi-process mode by number of processes
+#
+# For every value of --processes starts scripts/utils/mock_addreality.py and app.cluster.Cluster
+# with that many HTTP and processor processes, sends POST /turn_on/<device_id> for --devices devices
+# from --concurrency clients and waits till every device plays exactly one campaign.
+# Prints requests/sec of the HTTP front and switches/sec end to end for every number of processes.
+# Credentials of devices are put into the publishers cache before forking, so the publishers table is not used,
+# but the DB must be reachable as the API connects to it at start.
+# The mock is a single process, keep --latency above zero so it is not the bottleneck.
+
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+import app.data_classes as dc
+from app.addreality_handler import AddRealityHandler
+from scripts.utils.mock_addreality import serve as serve_mock
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Multi-process mode throughput benchmark')
+    parser.add_argument('--port', '-p', help='port of API started by benchmark', type=int, default=4100)
+    parser.add_argument('--mock-port', help='port of mock API started by benchmark', type=int, default=4200)
+    parser.add_argument('--processes', help='numbers of processes to compare', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--devices', '-d', help='devices switched', type=int, default=1000)
+    parser.add_argument('--concurrency', '-c', help='requests in flight', type=int, default=50)
+    parser.add_argument('--latency', '-l', help='seconds every mock response is delayed by', type=float, default=.02)
+    parser.add_argument('--timeout', help='seconds to wait for switches', type=float, default=300.)
+    return parser.parse_args()
+
+
+def serve_cluster(args, processes: int, work_dir: str) -> None:
+    os.setpgrp()
+    from app import context
+    from app.cluster import Cluster
+
+    context.api_config.processes = processes
+    context.processor_config.processes = processes
+    context.processor_config.queue = 'memory'
+    config = context.add_reality_config
+    config.api_url = f'http://127.0.0.1:{args.mock_port}'
+    config.content_store_path = os.path.join(work_dir, 'content_store.json')
+    config.upload_journal_path = os.path.join(work_dir, 'upload_journal')
+    config.rate_limit = config.global_rate_limit = 0
+    user = dc.User('bench', 'bench', 1)
+    for device_id in range(1, args.devices + 1):
+        context.publishers_cache.put(device_id, user)
+    Cluster(port=args.port).start()
+
+
+def wait_for_port(port: int, timeout: float = 10.) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(.1)
+    raise TimeoutError(f'Port {port} is not listened')
+
+
+async def send(args, content_path: str) -> int:
+    AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+    client = AsyncHTTPClient()
+    body = json.dumps({'name': content_path})
+    device_ids = iter(range(1, args.devices + 1))
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for device_id in device_ids:
+            try:
+                await client.fetch(
+                    f'http://127.0.0.1:{args.port}/turn_on/{device_id}',
+                    method='POST',
+                    body=body,
+                    headers={'Content-Type': 'application/json'},
+                )
+            except HTTPClientError:
+                errors += 1
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return errors
+
+
+def switched(handler: 'AddRealityHandler', devices: int) -> bool:
+    statuses = handler.get_campaign_statuses(force=True)
+    return len(statuses) == devices and all(status == 'playing' for status in statuses.values())
+
+
+def run(args, processes: int, content_path: str) -> tuple[float, float, int]:
+    mock = multiprocessing.Process(target=serve_mock, args=(args.mock_port, args.devices, args.latency), daemon=True)
+    mock.start()
+    with tempfile.TemporaryDirectory() as work_dir:
+        cluster = multiprocessing.Process(target=serve_cluster, args=(args, processes, work_dir))
+        cluster.start()
+        try:
+            wait_for_port(args.mock_port)
+            wait_for_port(args.port)
+            handler = AddRealityHandler(
+                dc.User('bench', 'bench', 1), dc.AddRealityConfig(api_url=f'http://127.0.0.1:{args.mock_port}'))
+            handler.ensure_authorized()
+
+            started = time.monotonic()
+            errors = asyncio.run(send(args, content_path))
+            sent = time.monotonic() - started
+            deadline = started + args.timeout
+            while not switched(handler, args.devices):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Devices are not switched in {args.timeout}s')
+                time.sleep(.2)
+            done = time.monotonic() - started
+        finally:
+            os.killpg(cluster.pid, signal.SIGTERM)
+            cluster.join(10)
+            mock.terminate()
+    return args.devices / sent, args.devices / done, errors
+
+
+def main():
+    args = parse_arguments()
+    with tempfile.NamedTemporaryFile(suffix='.png') as content:
+        content.write(b'0' * 1000)
+        content.flush()
+        results = {processes: run(args, processes, content.name) for processes in args.processes}
+
+    print(f'cores: {os.cpu_count()}, devices: {args.devices}, mock latency: {args.latency}s')
+    for processes, (requests_per_second, switches_per_second, errors) in results.items():
+        print(f'processes: {processes}, requests/sec: {requests_per_second:.1f}, '
+              f'switches/sec: {switches_per_second:.1f}, errors: {errors}')
+
+
+if __name__ == '__main__':
+    main()
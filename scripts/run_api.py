@@ -1,5 +1,8 @@
 from argparse import ArgumentParser
+
+from app import context
 from app.application import App
+from app.cluster import Cluster
 
 
 def parse_arguments() -> int:
@@ -11,5 +14,8 @@ def parse_arguments() -> int:
 
 if __name__ == "__main__":
     port = parse_arguments()
-    app = App(port=port)
-    app.start()
+    if context.api_config.processes > 1 or context.processor_config.processes > 1:
+        Cluster(port=port).start()
+    else:
+        app = App(port=port)
+        app.start()
@@ -1,10 +1,23 @@
 # Add Publisher
 
+from argparse import ArgumentParser
+
+import requests
+
 import app
 from app import models
 from app.utils import encode_password
 
+
+def parse_arguments():
+    parser = ArgumentParser(description='Add publisher')
+    parser.add_argument(
+        '--api', help='url of running API to drop its cached credentials of device, e.g. http://localhost:4000')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
+    args = parse_arguments()
     login = input("login: ")
     password_hash = encode_password(input("password: "))
     device_id = int(input("device_id: "))
@@ -18,3 +31,6 @@ if __name__ == '__main__':
             domain=None,
             platform_id=platform_id,
         ))
+
+    if args.api:
+        requests.post(f'{args.api.rstrip("/")}/publishers/{device_id}/invalidate', timeout=10)
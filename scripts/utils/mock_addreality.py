@@ -0,0 +1,230 @@
+# Mock AddReality API
+#
+# Serves the subset of AddReality API used by the service from memory: multi-step login with a session cookie,
+# devices, content storage with single and chunked uploads, campaigns v5/v6.
+# Requests without the session cookie get 401. --latency delays every response to imitate the network.
+# --rate-limit answers 429 with Retry-After to requests above that number per second.
+# --error-rate is the share of campaign creations answered with 502 after the campaign has been created.
+# Point the service at it with `api_url: http://localhost:4200` in the add_reality section of config.yaml.
+
+import asyncio
+import itertools
+import json
+import random
+import time
+import uuid
+from argparse import ArgumentParser
+from typing import Optional
+
+import tornado.web
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Mock AddReality API')
+    parser.add_argument('--port', '-p', help='listen on port', type=int, default=4200)
+    parser.add_argument('--latency', '-l', help='seconds every response is delayed by', type=float, default=0.)
+    parser.add_argument('--devices', '-d', help='number of devices, ids start from 1', type=int, default=100)
+    parser.add_argument('--rate-limit', help='requests per second served, 0 serves all', type=int, default=0)
+    parser.add_argument('--error-rate', help='share of campaign creations answered with 502', type=float,
+                        default=0.)
+    return parser.parse_args()
+
+
+class State:
+    def __init__(self, devices: int, latency: float, rate_limit: int = 0, error_rate: float = 0.):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        # second and number of requests served in it
+        self.window = (0, 0)
+        self.limited = 0
+        self.ids = itertools.count(1)
+        self.sessions: set[str] = set()
+        self.devices: dict[int, set[int]] = {device_id: set() for device_id in range(1, devices + 1)}
+        # content_id → name
+        self.content: dict[int, str] = {}
+        # file_id → bytes received and expected
+        self.uploads: dict[int, list[int]] = {}
+        # campaign_id → {'status', 'is_archived', 'devices'}
+        self.campaigns: dict[int, dict] = {}
+        self.requests = 0
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    state: 'State'
+    public = False
+
+    def initialize(self, state: 'State'):
+        self.state = state
+
+    async def prepare(self):
+        self.state.requests += 1
+        if self.state.latency:
+            await asyncio.sleep(self.state.latency)
+        if self.state.rate_limit:
+            second, served = self.state.window
+            now = int(time.time())
+            served = served + 1 if second == now else 1
+            self.state.window = (now, served)
+            if served > self.state.rate_limit:
+                self.state.limited += 1
+                self.set_status(429)
+                self.set_header('Retry-After', '1')
+                self.finish({'error': 'too many requests'})
+                return
+        if not self.public and self.get_cookie('session') not in self.state.sessions:
+            self.set_status(401)
+            self.finish({'error': 'unauthorized'})
+
+    @property
+    def payload(self) -> dict:
+        """Body sent as JSON string or as form."""
+        try:
+            return json.loads(self.request.body)
+        except ValueError:
+            return {key: self.get_body_argument(key) for key in self.request.body_arguments}
+
+    def campaign(self, campaign_id: str) -> Optional[dict]:
+        campaign = self.state.campaigns.get(int(campaign_id))
+        if campaign is None:
+            self.set_status(404)
+            self.finish({'error': 'not found'})
+        return campaign
+
+    def listing(self, archived: bool) -> dict:
+        return {'campaigns': [
+            {'id': campaign_id, 'name': campaign['name'], 'status': campaign['status']}
+            for campaign_id, campaign in self.state.campaigns.items() if campaign['is_archived'] == archived
+        ]}
+
+
+class Login(BaseHandler):
+    public = True
+
+    def post(self, step: str):
+        if step == 'start':
+            self.write({'session_id': uuid.uuid4().hex})
+        elif step == 'finish':
+            token = uuid.uuid4().hex
+            self.state.sessions.add(token)
+            self.set_cookie('session', token)
+            self.write({})
+        else:
+            self.write({})
+
+
+class Devices(BaseHandler):
+    def get(self, platform_id: str):
+        self.write({'devices': [
+            {'id': device_id, 'name': f'device {device_id}', 'status': 'online'} for device_id in self.state.devices
+        ]})
+
+
+class Device(BaseHandler):
+    def get(self, platform_id: str, device_id: str):
+        campaigns = self.state.devices.get(int(device_id), set())
+        self.write({'id': int(device_id), 'campaigns': [{'id': campaign_id} for campaign_id in sorted(campaigns)]})
+
+    def put(self, platform_id: str, device_id: str):
+        self.write({})
+
+
+class Content(BaseHandler):
+    def get(self, platform_id: str):
+        self.write({'content': [{'id': content_id, 'name': name} for content_id, name in self.state.content.items()]})
+
+
+class Upload(BaseHandler):
+    def post(self, platform_id: str):
+        chunk = self.request.files['chunk'][0]['body']
+        size = int(self.get_body_argument('size'))
+        file_id = self.get_body_argument('file_id', None)
+        if file_id is None:
+            file_id = next(self.state.ids)
+            self.state.uploads[file_id] = [0, size]
+        upload = self.state.uploads[int(file_id)]
+        upload[0] += len(chunk)
+        if upload[0] < upload[1]:
+            self.write({'file_id': int(file_id)})
+            return
+        del self.state.uploads[int(file_id)]
+        content_id = next(self.state.ids)
+        self.state.content[content_id] = self.get_body_argument('name')
+        self.write({'file_id': int(file_id), 'id': content_id})
+
+
+class Campaigns(BaseHandler):
+    def get(self, platform_id: str):
+        self.write(self.listing(archived=False))
+
+    def post(self, platform_id: str):
+        payload = self.payload
+        campaign_id = next(self.state.ids)
+        devices = set(payload.get('devices_delta', {}).get('selected', []))
+        self.state.campaigns[campaign_id] = {
+            'name': payload.get('name'), 'status': payload.get('status', 'paused'), 'is_archived': False,
+            'devices': devices,
+        }
+        for device_id in devices:
+            self.state.devices.setdefault(device_id, set()).add(campaign_id)
+        if random.random() < self.state.error_rate:
+            self.set_status(502)
+            self.finish({'error': 'bad gateway'})
+            return
+        self.write({'id': campaign_id, 'status': self.state.campaigns[campaign_id]['status']})
+
+
+class Archive(BaseHandler):
+    def get(self, platform_id: str):
+        self.write(self.listing(archived=True))
+
+
+class Campaign(BaseHandler):
+    def put(self, platform_id: str, campaign_id: str):
+        campaign = self.campaign(campaign_id)
+        if campaign is None:
+            return
+        payload = self.payload
+        if 'status' in payload:
+            campaign['status'] = payload['status']
+        if payload.get('is_archived'):
+            campaign['is_archived'] = True
+            campaign['status'] = 'archived'
+        self.write({'id': int(campaign_id)})
+
+    def delete(self, platform_id: str, campaign_id: str):
+        if self.campaign(campaign_id) is None:
+            return
+        campaign = self.state.campaigns.pop(int(campaign_id))
+        for device_id in campaign['devices']:
+            self.state.devices.get(device_id, set()).discard(int(campaign_id))
+        self.write({})
+
+
+def make_app(state: 'State') -> 'tornado.web.Application':
+    args = {'state': state}
+    return tornado.web.Application([
+        (r'/v5/auth/login/multi_step/(\w+)', Login, args),
+        (r'/v5/platforms/(\d+)/devices', Devices, args),
+        (r'/v5/platforms/(\d+)/devices/(\d+)', Device, args),
+        (r'/v5/platforms/(\d+)/content/groups/0', Content, args),
+        (r'/v5/platforms/(\d+)/content/file/upload', Upload, args),
+        (r'/v5/platforms/(\d+)/campaign/groups/0', Campaigns, args),
+        (r'/v5/platforms/(\d+)/campaign/archive', Archive, args),
+        (r'/v[56]/platforms/(\d+)/campaign', Campaigns, args),
+        (r'/v[56]/platforms/(\d+)/campaign/(\d+)', Campaign, args),
+    ])
+
+
+def serve(port: int, devices: int = 100, latency: float = 0., rate_limit: int = 0, error_rate: float = 0.) -> None:
+    async def main():
+        make_app(State(devices, latency, rate_limit, error_rate)).listen(port)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    print(f'Mock AddReality API on http://localhost:{args.port}')
+    serve(args.port, args.devices, args.latency, args.rate_limit, args.error_rate)